@@ -0,0 +1,1056 @@
+#!/usr/bin/env python
+#
+# Distributed under LGPL 2.1 or later
+# (c) Stian Soiland-Reyes 2002-2015
+# stian@soiland-reyes.com
+# https://github.com/stain/forgetSQL
+#
+"""Benchmarks for forgetSQL.
+
+The benchmarks run against an in-process SQLite database that stands
+in for a real database server. The stand-in translates the format
+parameter style used by forgetSQL (%s) to the qmark style of sqlite3,
+emulates PostgreSQL sequences through a nextval() function and
+generate_series() through a recursive query, and counts
+every statement that is executed, so that both the speed and the
+number of round trips of each operation can be reported.
+
+A schema of foreign key chains (chain <- shop <- address) and a wide
+table is generated with a size given by --rows, Forgetter subclasses
+are made for them with forgetSQL.prepareClasses(), and each benchmark
+is timed in a separate forked process so that the peak memory of one
+benchmark does not hide the peak of the next one.
+
+Usage::
+
+    python bench/forgetbench.py --rows 100k
+    python bench/forgetbench.py --rows 100k --save before.json
+    python bench/forgetbench.py --rows 100k --compare before.json
+
+With --compare the exit status is 1 if any benchmark got slower than
+--threshold percent (ops/sec), or executes more queries than before.
+"""
+
+import os
+import sys
+import re
+import time
+import random
+import sqlite3
+
+try:
+    import json
+except ImportError:
+    json = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Use the forgetSQL from this source tree, not an installed one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+import forgetSQL
+
+
+class StandInCursor(object):
+    """DB-API cursor wrapping a sqlite3 cursor.
+
+    Statements are translated from the format parameter style to
+    qmark, and counted in the connection's statistics.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = connection._connection.cursor()
+
+    def _translate(self, sql):
+        sql = sql.replace('%%', '\0').replace('%s', '?')
+        return sql.replace('\0', '%')
+
+    def _emulate(self, sql):
+        """Rewrite PostgreSQL specific SQL for SQLite"""
+        return re.sub(r'FROM generate_series\(1, (\d+)\)',
+                      r'FROM (WITH RECURSIVE series(n) AS (SELECT 1 '
+                      r'UNION ALL SELECT n+1 FROM series WHERE n < \1) '
+                      r'SELECT n FROM series)', sql)
+
+    def _count(self, sql, rows=1):
+        kind = sql.split(None, 1)[0].upper()
+        stats = self.connection.stats
+        stats[kind] = stats.get(kind, 0) + 1
+        self.connection.queries += 1
+        self.connection.rows += rows
+
+    def execute(self, sql, params=None):
+        self._count(sql)
+        sql = self._emulate(sql)
+        if params is None:
+            # Like other format drivers, % is not special without
+            # parameters
+            return self._cursor.execute(sql)
+        return self._cursor.execute(self._translate(sql), tuple(params))
+
+    def executemany(self, sql, seq):
+        seq = [tuple(params) for params in seq]
+        self._count(sql, len(seq))
+        return self._cursor.executemany(self._translate(sql), seq)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._cursor.fetchmany()
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+    def _description(self):
+        return self._cursor.description
+    description = property(_description)
+
+    def _rowcount(self):
+        return self._cursor.rowcount
+    rowcount = property(_rowcount)
+
+    def _lastrowid(self):
+        return self._cursor.lastrowid
+    lastrowid = property(_lastrowid)
+
+
+class StandInConnection(object):
+    """In-process SQLite database standing in for a database server."""
+    def __init__(self, filename=':memory:'):
+        self._connection = sqlite3.connect(filename)
+        # forgetSQL assumes autocommit
+        self._connection.isolation_level = None
+        self._connection.create_function('nextval', 1, self._nextval)
+        self._sequences = {}
+        self.resetStats()
+
+    def _nextval(self, name):
+        value = self._sequences.get(name, 0) + 1
+        self._sequences[name] = value
+        return value
+
+    def setSequence(self, name, value):
+        self._sequences[name] = value
+
+    def resetStats(self):
+        self.stats = {}
+        self.queries = 0
+        self.rows = 0
+
+    def cursor(self):
+        return StandInCursor(self)
+
+    def commit(self):
+        self._end("COMMIT")
+
+    def rollback(self):
+        self._end("ROLLBACK")
+
+    def _end(self, sql):
+        curs = self.cursor()
+        try:
+            curs.execute(sql)
+        except sqlite3.OperationalError:
+            # No transaction was begun, we're in autocommit mode
+            pass
+        curs.close()
+
+    def close(self):
+        self._connection.close()
+
+
+def parseSize(text):
+    """Parse sizes like 1000, 10k and 10M"""
+    text = text.strip().lower()
+    factor = 1
+    if text[-1:] in ('k', 'm'):
+        factor = {'k': 1000, 'm': 1000000}[text[-1]]
+        text = text[:-1]
+    return int(float(text) * factor)
+
+
+WIDE_COLUMNS = 60
+
+class Schema(object):
+    """Generated schema with foreign key chains and a wide table.
+
+    For rows shops there will be rows/100 chains, 2*rows addresses and
+    rows rows in the wide table.
+    """
+    def __init__(self, connection, rows):
+        self.connection = connection
+        self.rows = rows
+        self.chains = max(1, rows / 100)
+        self.addresses = rows * 2
+        self.create()
+        self.populate()
+        self.classes = self.makeClasses()
+
+    def create(self):
+        curs = self.connection._connection.cursor()
+        curs.execute("""CREATE TABLE chain (
+                            chain_id INTEGER PRIMARY KEY,
+                            name TEXT NOT NULL,
+                            version INTEGER NOT NULL DEFAULT 1)""")
+        curs.execute("""CREATE TABLE shop (
+                            shop_id INTEGER PRIMARY KEY,
+                            name TEXT NOT NULL,
+                            chain_id INTEGER REFERENCES chain,
+                            opened TEXT,
+                            rating REAL)""")
+        curs.execute("""CREATE TABLE address (
+                            address_id INTEGER PRIMARY KEY,
+                            shop_id INTEGER REFERENCES shop,
+                            street TEXT,
+                            city TEXT,
+                            zip TEXT)""")
+        curs.execute("""CREATE TABLE shop_info (
+                            shop_id INTEGER PRIMARY KEY REFERENCES shop,
+                            description TEXT,
+                            phone TEXT)""")
+        curs.execute("CREATE INDEX address_shop_id ON address (shop_id)")
+        curs.execute("CREATE UNIQUE INDEX shop_name ON shop (name)")
+        columns = []
+        for i in range(WIDE_COLUMNS):
+            columns.append("c%02d %s" % (i, ('TEXT', 'INTEGER', 'REAL')[i%3]))
+        curs.execute("CREATE TABLE wide (wide_id INTEGER PRIMARY KEY, %s)"
+                     % ', '.join(columns))
+        curs.close()
+
+    def _chunks(self, count, generate, size=10000):
+        start = 1
+        while start <= count:
+            stop = min(count, start + size - 1)
+            yield [generate(i) for i in xrange(start, stop+1)]
+            start = stop + 1
+
+    def populate(self):
+        curs = self.connection._connection.cursor()
+        rnd = random.Random(42)
+        for rows in self._chunks(self.chains,
+                                 lambda i: (i, 'Chain %d' % i)):
+            curs.executemany("INSERT INTO chain VALUES (?, ?, 1)", rows)
+        for rows in self._chunks(self.rows,
+                lambda i: (i, 'Shop %d' % i, rnd.randint(1, self.chains),
+                           '2015-%02d-%02d' % (i%12+1, i%28+1),
+                           rnd.random() * 5)):
+            curs.executemany("INSERT INTO shop VALUES (?, ?, ?, ?, ?)", rows)
+        for rows in self._chunks(self.rows,
+                lambda i: (i, 'About shop %d' % i, '+47 %08d' % i)):
+            curs.executemany("INSERT INTO shop_info VALUES (?, ?, ?)", rows)
+        for rows in self._chunks(self.addresses,
+                lambda i: (i, (i+1)/2, 'Street %d' % i, 'City %d' % (i%500),
+                           '%04d' % (i%10000))):
+            curs.executemany("INSERT INTO address VALUES (?, ?, ?, ?, ?)",
+                             rows)
+        def wideRow(i):
+            row = [i]
+            for c in range(WIDE_COLUMNS):
+                row.append((u'value %d' % i, i, i * 0.5)[c%3])
+            return row
+        marks = ', '.join(['?'] * (WIDE_COLUMNS+1))
+        for rows in self._chunks(self.rows, wideRow):
+            curs.executemany("INSERT INTO wide VALUES (%s)" % marks, rows)
+        curs.close()
+        for (table, count) in (('chain', self.chains), ('shop', self.rows),
+                               ('address', self.addresses),
+                               ('wide', self.rows)):
+            self.connection.setSequence('%s_id_seq' % table, count)
+
+    def makeClasses(self):
+        connection = self.connection
+        class _Wrapper(forgetSQL.Forgetter):
+            _autosave = False
+            _dbModule = sqlite3
+            def cursor(cls):
+                return connection.cursor()
+            cursor = classmethod(cursor)
+
+        class Chain(_Wrapper):
+            _sqlTable = 'chain'
+            _sqlSequence = 'chain_id_seq'
+            _sqlFields = {'id': 'chain_id', 'name': 'name',
+                          'version': 'version'}
+            _shortView = ('name',)
+
+        class Shop(_Wrapper):
+            _sqlTable = 'shop'
+            _sqlSequence = 'shop_id_seq'
+            _sqlFields = {'id': 'shop_id', 'name': 'name',
+                          'chain': 'chain_id', 'opened': 'opened',
+                          'rating': 'rating'}
+            _userClasses = {'chain': 'Chain'}
+            _shortView = ('name',)
+
+        class Address(_Wrapper):
+            _sqlTable = 'address'
+            _sqlSequence = 'address_id_seq'
+            _sqlFields = {'id': 'address_id', 'shop': 'shop_id',
+                          'street': 'street', 'city': 'city', 'zip': 'zip'}
+            _userClasses = {'shop': 'Shop'}
+            _shortView = ('street', 'city')
+
+        class ShopFull(_Wrapper):
+            _sqlTable = 'shop'
+            _sqlSequence = 'shop_id_seq'
+            _sqlFields = {'id': 'shop_id', 'name': 'name',
+                          'chain': 'chain_id', 'opened': 'opened',
+                          'rating': 'rating',
+                          'description': 'shop_info.description',
+                          'phone': 'shop_info.phone'}
+            _sqlLinks = (('shop_id', 'shop_info.shop_id'),)
+            _sqlJoin = 'LEFT'
+            _saveLinks = True
+            _userClasses = {'chain': 'Chain'}
+
+        wideFields = {'id': 'wide_id'}
+        for i in range(WIDE_COLUMNS):
+            wideFields['c%02d' % i] = 'c%02d' % i
+        class Wide(_Wrapper):
+            _sqlTable = 'wide'
+            _sqlSequence = 'wide_id_seq'
+            _sqlFields = wideFields
+
+        # The REAL columns as decimals
+        wideTypes = {}
+        for i in range(2, WIDE_COLUMNS, 3):
+            wideTypes['c%02d' % i] = 'decimal'
+        class WideTyped(Wide):
+            _sqlFields = wideFields.copy()
+            _sqlTypes = wideTypes
+
+        classes = {'Chain': Chain, 'Shop': Shop, 'Address': Address,
+                   'ShopFull': ShopFull, 'Wide': Wide,
+                   'WideTyped': WideTyped}
+        forgetSQL.prepareClasses(classes)
+        return classes
+
+
+class Benchmark(object):
+    """A named benchmark.
+
+    setup(schema, ops) is run untimed before run(schema, ops, state),
+    state is whatever setup returned. run() should return the number of
+    operations actually performed. teardown(state), if given, is run
+    untimed afterwards.
+    """
+    def __init__(self, name, run, setup=None, description='',
+                 teardown=None):
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.teardown = teardown
+        self.description = description
+
+BENCHMARKS = []
+
+def benchmark(name, description='', setup=None, teardown=None):
+    def register(run):
+        BENCHMARKS.append(Benchmark(name, run, setup, description,
+                                    teardown))
+        return run
+    return register
+
+
+def sampleIDs(count, ops, seed=1):
+    rnd = random.Random(seed)
+    return [rnd.randint(1, count) for i in xrange(ops)]
+
+@benchmark('load', 'Shop(id).load() of random shops')
+def benchLoad(schema, ops, state):
+    Shop = schema.classes['Shop']
+    for id in sampleIDs(schema.rows, ops):
+        Shop(id).load()
+    return ops
+
+@benchmark('load_wide', 'Wide(id).load() of random rows, %d columns'
+                        % WIDE_COLUMNS)
+def benchLoadWide(schema, ops, state):
+    Wide = schema.classes['Wide']
+    for id in sampleIDs(schema.rows, ops):
+        Wide(id).load()
+    return ops
+
+@benchmark('load_joined', 'ShopFull(id).load() of random shops, '
+                          'joined with shop_info')
+def benchLoadJoined(schema, ops, state):
+    ShopFull = schema.classes['ShopFull']
+    for id in sampleIDs(schema.rows, ops):
+        ShopFull(id).load()
+    return ops
+
+@benchmark('load_wide_typed', 'WideTyped(id).load() of random rows, %d '
+                              'decimal columns' % (WIDE_COLUMNS / 3))
+def benchLoadWideTyped(schema, ops, state):
+    WideTyped = schema.classes['WideTyped']
+    for id in sampleIDs(schema.rows, ops):
+        WideTyped(id).load()
+    return ops
+
+def scanWhere(schema, ops):
+    return ["shop.shop_id <= %d" % min(ops, schema.rows)]
+
+@benchmark('cached_access', 'Shop(id).name of random shops, mostly cached')
+def benchCachedAccess(schema, ops, state):
+    Shop = schema.classes['Shop']
+    shops = []
+    for id in sampleIDs(min(schema.rows, max(1, ops/10)), ops):
+        shop = Shop(id)
+        shop.name
+        # keep them alive
+        shops.append(shop)
+    return ops
+
+def setupExpiredChains(schema, ops):
+    """Load chains and make their cache entries expire"""
+    Chain = schema.classes['Chain']
+    chains = list(Chain.getAllIterator())
+    # Change every 100th
+    curs = schema.connection._connection.cursor()
+    curs.execute("UPDATE chain SET version=version+1 WHERE chain_id % 100 = 0")
+    curs.close()
+    for (key, (ref, updated)) in Chain._cache.items():
+        Chain._cache[key] = (ref, updated - Chain._timeout - 1)
+    return chains
+
+@benchmark('expired_reload', 'Chain(id).name of expired chains',
+           setupExpiredChains)
+def benchExpiredReload(schema, ops, state):
+    Chain = schema.classes['Chain']
+    for chain in state:
+        Chain(chain.id).name
+    return len(state)
+
+def setupVersionedChains(schema, ops):
+    schema.classes['Chain']._sqlVersion = 'version'
+    return setupExpiredChains(schema, ops)
+
+@benchmark('expired_revalidate', 'Chain(id).name of expired chains with '
+                                 '_sqlVersion', setupVersionedChains)
+def benchExpiredRevalidate(schema, ops, state):
+    return benchExpiredReload(schema, ops, state)
+
+@benchmark('reference_access', 'shop.chain.name of the first ops shops')
+def benchReferenceAccess(schema, ops, state):
+    count = 0
+    for shop in schema.classes['Shop'].getAllIterator(scanWhere(schema, ops)):
+        shop.chain.name
+        count += 1
+    return count
+
+@benchmark('reference_access_preload', 'shop.chain.name of the first ops '
+                                       'shops with Chain._preload')
+def benchReferenceAccessPreload(schema, ops, state):
+    schema.classes['Chain']._preload = True
+    return benchReferenceAccess(schema, ops, state)
+
+def sampleNames(schema, ops):
+    return ['Shop %d' % id
+            for id in sampleIDs(min(schema.rows, max(1, ops/10)), ops)]
+
+@benchmark('getAll_by_name', 'Shop.getAll(name) of random shops, repeated')
+def benchGetAllByName(schema, ops, state):
+    Shop = schema.classes['Shop']
+    shops = []
+    for name in sampleNames(schema, ops):
+        shop = Shop.getAll([("shop.name=%s", (name,))])[0]
+        shop.name
+        shops.append(shop)
+    return ops
+
+@benchmark('getBy', 'Shop.getBy(name=name) of random shops, repeated')
+def benchGetBy(schema, ops, state):
+    Shop = schema.classes['Shop']
+    Shop._sqlUnique = ('name',)
+    shops = []
+    for name in sampleNames(schema, ops):
+        shop = Shop.getBy(name=name)
+        shop.name
+        shops.append(shop)
+    return ops
+
+@benchmark('getAll', 'Shop.getAll() of the first ops shops')
+def benchGetAll(schema, ops, state):
+    return len(schema.classes['Shop'].getAll(scanWhere(schema, ops)))
+
+@benchmark('getAllIterator', 'Shop.getAllIterator() of the first ops shops')
+def benchGetAllIterator(schema, ops, state):
+    count = 0
+    for shop in schema.classes['Shop'].getAllIterator(scanWhere(schema, ops)):
+        count += 1
+    return count
+
+@benchmark('getAll_scan', 'Shop.getAll() of the first ops shops, reading '
+                          'every name')
+def benchGetAllScan(schema, ops, state):
+    count = 0
+    for shop in schema.classes['Shop'].getAll(scanWhere(schema, ops)):
+        shop.name
+        count += 1
+    return count
+
+@benchmark('getAll_lazy_scan', 'Shop.getAll(lazy=True) of the first ops '
+                               'shops, reading every name')
+def benchGetAllLazyScan(schema, ops, state):
+    count = 0
+    for shop in schema.classes['Shop'].getAll(scanWhere(schema, ops),
+                                              lazy=True):
+        shop.name
+        count += 1
+    return count
+
+def browsePages(schema, ops, lazy):
+    Shop = schema.classes['Shop']
+    pages = max(1, ops / 100)
+    for i in range(pages):
+        shops = Shop.getAll(orderBy='id', lazy=lazy, page=20)
+        for shop in shops[:20]:
+            shop.name
+    return pages
+
+@benchmark('getAll_first_page', 'the first 20 names of Shop.getAll() of all '
+                                'shops, ops/100 times')
+def benchGetAllFirstPage(schema, ops, state):
+    return browsePages(schema, ops, False)
+
+@benchmark('getAll_lazy_first_page', 'the first 20 names of '
+                                     'Shop.getAll(lazy=True) of all shops, '
+                                     'ops/100 times')
+def benchGetAllLazyFirstPage(schema, ops, state):
+    return browsePages(schema, ops, True)
+
+@benchmark('getAllIterator_profiled', 'Shop.getAllIterator() of the first '
+                                      'ops shops, profiling 10% of the '
+                                      'operations')
+def benchGetAllIteratorProfiled(schema, ops, state):
+    try:
+        profiler = forgetSQL.profile(0.1).start()
+    except ValueError:
+        # Already profiled by --profile
+        return benchGetAllIterator(schema, ops, state)
+    try:
+        return benchGetAllIterator(schema, ops, state)
+    finally:
+        profiler.stop()
+
+@benchmark('getAllIterator_references', 'Address.getAllIterator() of the '
+                                        'first ops addresses, reading '
+                                        'every shop reference')
+def benchGetAllIteratorReferences(schema, ops, state):
+    where = ["address.address_id <= %d" % min(ops, schema.rows)]
+    count = 0
+    for address in schema.classes['Address'].getAllIterator(where):
+        address.shop
+        count += 1
+    return count
+
+@benchmark('getAllIterator_wide', 'Wide.getAllIterator() of the first '
+                                  'ops rows')
+def benchGetAllIteratorWide(schema, ops, state):
+    where = ["wide.wide_id <= %d" % min(ops, schema.rows)]
+    count = 0
+    for wide in schema.classes['Wide'].getAllIterator(where):
+        count += 1
+    return count
+
+@benchmark('getAllIDs', 'Shop.getAllIDs() of the first ops shops')
+def benchGetAllIDs(schema, ops, state):
+    return len(schema.classes['Shop'].getAllIDs(scanWhere(schema, ops)))
+
+def sampleChains(schema, ops):
+    return [[('shop.chain_id=%s', (id,))]
+            for id in sampleIDs(min(schema.chains, 10), ops)]
+
+@benchmark('getAllText', 'Shop.getAllText() of shops in one of 10 chains')
+def benchGetAllText(schema, ops, state):
+    Shop = schema.classes['Shop']
+    for where in sampleChains(schema, ops):
+        Shop.getAllText(where, orderBy='name')
+    return ops
+
+@benchmark('getAllText_cached', 'Shop.getAllText() of shops in one of 10 '
+                                'chains, _resultTimeout = 60, a save() every '
+                                '100 calls')
+def benchGetAllTextCached(schema, ops, state):
+    Shop = schema.classes['Shop']
+    Shop._resultTimeout = 60
+    Shop._resultMemory = 64 * 1024 * 1024
+    shop = Shop(1)
+    count = 0
+    for where in sampleChains(schema, ops):
+        Shop.getAllText(where, orderBy='name')
+        count += 1
+        if count % 100 == 0:
+            shop.rating = count
+            shop.save()
+    return ops
+
+def setupShops(schema, ops):
+    Shop = schema.classes['Shop']
+    return [Shop(id) for id in sampleIDs(schema.rows, ops)]
+
+@benchmark('getChildren', 'shop.getChildren(Address) of random shops',
+           setupShops)
+def benchGetChildren(schema, ops, state):
+    Address = schema.classes['Address']
+    for shop in state:
+        shop.getChildren(Address)
+    return len(state)
+
+@benchmark('getChildrenOf', 'Address.getChildrenOf() of random shops',
+           setupShops)
+def benchGetChildrenOf(schema, ops, state):
+    schema.classes['Address'].getChildrenOf(state)
+    return len(state)
+
+@benchmark('save_insert', 'save() of new shops')
+def benchSaveInsert(schema, ops, state):
+    Shop = schema.classes['Shop']
+    Chain = schema.classes['Chain']
+    for i in xrange(ops):
+        shop = Shop()
+        shop.name = 'New shop %d' % i
+        shop.chain = Chain(i % schema.chains + 1)
+        shop.opened = '2015-01-01'
+        shop.rating = 2.5
+        shop.save()
+    return ops
+
+def setupLoadedShops(schema, ops):
+    shops = setupShops(schema, ops)
+    for shop in shops:
+        shop.load()
+    return shops
+
+@benchmark('save_update', 'save() of changed, loaded shops',
+           setupLoadedShops)
+def benchSaveUpdate(schema, ops, state):
+    for shop in state:
+        shop.rating = 1.0
+        shop.save()
+    return len(state)
+
+def setupLoadedShopsFull(schema, ops):
+    ShopFull = schema.classes['ShopFull']
+    shops = [ShopFull(id) for id in sampleIDs(schema.rows, ops)]
+    for shop in shops:
+        shop.load()
+    return shops
+
+@benchmark('save_joined', 'save() of changed ShopFull, with shop_info',
+           setupLoadedShopsFull)
+def benchSaveJoined(schema, ops, state):
+    for shop in state:
+        shop.rating = 1.0
+        shop.phone = '+47 12345678'
+        shop.save()
+    return len(state)
+
+def setupLoadedWide(schema, ops, name='Wide'):
+    Wide = schema.classes[name]
+    rows = [Wide(id) for id in range(1, min(ops, schema.rows)+1)]
+    for row in rows:
+        row.load()
+    return rows
+
+@benchmark('save_wide', 'save() of changed, loaded Wide rows, %d columns'
+                        % WIDE_COLUMNS, setupLoadedWide)
+def benchSaveWide(schema, ops, state):
+    for row in state:
+        row.c00 = u'changed'
+        row.save()
+    return len(state)
+
+def setupLoadedWideTyped(schema, ops):
+    return setupLoadedWide(schema, ops, 'WideTyped')
+
+@benchmark('save_wide_typed', 'save() of changed, loaded WideTyped rows, '
+                              '%d decimal columns' % (WIDE_COLUMNS / 3),
+           setupLoadedWideTyped)
+def benchSaveWideTyped(schema, ops, state):
+    for row in state:
+        row.c00 = u'changed'
+        row.save()
+    return len(state)
+
+def runRequests(schema, ops, transaction):
+    """Requests loading 30 random shops and changing 5 of them, with
+    about ops operations in all, each request in a transaction if
+    transaction is true."""
+    Shop = schema.classes['Shop']
+    requests = max(1, ops / 35)
+    ids = sampleIDs(schema.rows, requests * 30)
+    for request in xrange(requests):
+        if transaction:
+            current = forgetSQL.transaction(schema.connection,
+                                            begin=True).start()
+        shops = [Shop(id) for id in ids[request*30:request*30+30]]
+        for shop in shops:
+            shop.name
+        for shop in shops[:5]:
+            shop.rating = request % 5
+            shop.save()
+        if transaction:
+            current.commit()
+    return requests * 35
+
+@benchmark('request_autocommit', 'requests loading 30 shops and saving 5, '
+                                 'in autocommit mode')
+def benchRequestAutocommit(schema, ops, state):
+    return runRequests(schema, ops, False)
+
+@benchmark('request_transaction', 'requests loading 30 shops and saving 5, '
+                                  'each in a transaction()')
+def benchRequestTransaction(schema, ops, state):
+    return runRequests(schema, ops, True)
+
+def setupChanges(schema, ops):
+    shops = setupLoadedShops(schema, ops)
+    events = []
+    for shop in shops:
+        values = {'shop_id': shop.id, 'name': shop.name + ' changed',
+                  'chain_id': shop.chain and shop.chain.id,
+                  'opened': shop.opened, 'rating': 4.5}
+        events.append(('shop', {'shop_id': shop.id}, values))
+    return (shops, events)
+
+@benchmark('changes_reload', 'load() of changed, loaded shops, as without '
+                             'replayChanges()', setupChanges)
+def benchChangesReload(schema, ops, state):
+    (shops, events) = state
+    for shop in shops:
+        shop.load()
+        shop.name
+    return len(events)
+
+@benchmark('changes_replay', 'replayChanges() of changes to loaded shops',
+           setupChanges)
+def benchChangesReplay(schema, ops, state):
+    (shops, events) = state
+    forgetSQL.replayChanges(events, [schema.classes['Shop']])
+    for shop in shops:
+        shop.name
+    return len(events)
+
+def setupAddresses(schema, ops):
+    Address = schema.classes['Address']
+    return [Address(id) for id in range(1, min(ops, schema.addresses)+1)]
+
+@benchmark('delete', 'delete() of addresses', setupAddresses)
+def benchDelete(schema, ops, state):
+    for address in state:
+        address.delete()
+    return len(state)
+
+
+def newShops(schema, ops):
+    Chain = schema.classes['Chain']
+    for i in xrange(ops):
+        yield {'name': 'New shop %d' % i,
+               'chain': Chain(i % schema.chains + 1),
+               'opened': '2015-01-01', 'rating': 2.5}
+
+@benchmark('bulkInsert', 'Shop.bulkInsert() of new shops')
+def benchBulkInsert(schema, ops, state):
+    return len(schema.classes['Shop'].bulkInsert(newShops(schema, ops)))
+
+@benchmark('bulkInsert_executemany', 'Shop.bulkInsert() of new shops with '
+                                     'executemany()')
+def benchBulkInsertExecutemany(schema, ops, state):
+    Shop = schema.classes['Shop']
+    Shop._bulkInsertMode = 'executemany'
+    return len(Shop.bulkInsert(newShops(schema, ops)))
+
+@benchmark('bulkInsert_upsert', 'Shop.bulkInsert(upsert=True) of '
+                                'existing shops')
+def benchBulkUpsert(schema, ops, state):
+    rows = [{'id': id, 'name': 'Synced %d' % id, 'rating': 3.0}
+            for id in range(1, min(ops, schema.rows)+1)]
+    return len(schema.classes['Shop'].bulkInsert(rows, upsert=True))
+
+@benchmark('updateWhere', 'Address.updateWhere() of the first ops addresses')
+def benchUpdateWhere(schema, ops, state):
+    limit = min(ops, schema.addresses)
+    schema.classes['Address'].updateWhere({'city': 'Updated'},
+                                [('address.address_id <= %s', (limit,))])
+    return limit
+
+@benchmark('deleteWhere', 'Address.deleteWhere() of the first ops addresses')
+def benchDeleteWhere(schema, ops, state):
+    limit = min(ops, schema.addresses)
+    schema.classes['Address'].deleteWhere(
+                                [('address.address_id <= %s', (limit,))])
+    return limit
+
+
+GENERATED_COLUMNS = 8
+
+def setupGenerated(static):
+    """Setup generating a module of ops classes with forgetsql-generate.
+
+    The tables, each with a foreign key to the one before, are made in
+    a separate database, and the module is generated and compiled in a
+    forked child, so that neither is included in the time or peak
+    memory of the import. The state is (directory, module name).
+    """
+    def setup(schema, ops):
+        import tempfile
+        directory = tempfile.mkdtemp(prefix='forgetbench')
+        name = 'generated_bench'
+        filename = os.path.join(directory, name + '.py')
+        if not hasattr(os, 'fork'):
+            generateModule(filename, ops, static)
+            return (directory, name)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                generateModule(filename, ops, static)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        return (directory, name)
+    return setup
+
+def generateModule(filename, ops, static):
+    """Generate and compile a module of ops classes to filename."""
+    import imp, py_compile, StringIO
+    generator = imp.load_source('forgetsql_generate',
+                    os.path.join(os.path.dirname(os.path.abspath(
+                                 __file__)), os.pardir, 'bin',
+                                 'forgetsql-generate'))
+    connection = StandInConnection()
+    curs = connection.cursor()
+    for i in xrange(ops):
+        columns = ['t%d_id INTEGER PRIMARY KEY' % i]
+        columns += ['c%d TEXT' % c for c in range(GENERATED_COLUMNS)]
+        if i:
+            columns.append('t%d_id INTEGER REFERENCES t%d' % (i-1, i-1))
+        curs.execute('CREATE TABLE t%d (%s)' % (i, ', '.join(columns)))
+    code = {'module': 'sqlite3', 'database': 'bench', 'connect': ''}
+    output = StringIO.StringIO()
+    stdout = sys.stdout
+    sys.stdout = output
+    try:
+        generator.generateFromTables([], connection.cursor, code=code,
+                                     static=static)
+    finally:
+        sys.stdout = stdout
+    connection.close()
+    open(filename, 'w').write(output.getvalue())
+    py_compile.compile(filename)
+
+def teardownGenerated(state):
+    import shutil
+    shutil.rmtree(state[0])
+
+def benchImport(schema, ops, state):
+    (directory, name) = state
+    sys.path.insert(0, directory)
+    try:
+        module = __import__(name)
+    finally:
+        del sys.path[0]
+    return len([value for value in vars(module).values()
+                if type(value) is type and
+                   issubclass(value, forgetSQL.Forgetter) and
+                   value.__name__ <> '_Wrapper'])
+
+benchmark('import_generated', 'import of a generated module of ops classes',
+          setupGenerated(False), teardownGenerated)(benchImport)
+benchmark('import_static', 'import of a --static generated module of ops '
+          'classes', setupGenerated(True), teardownGenerated)(benchImport)
+
+
+def residentKiB():
+    """Current resident set size in KiB, or 0 if unknown."""
+    try:
+        pages = int(open('/proc/self/statm').read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024
+
+def peakKiB():
+    """Peak resident set size in KiB, or 0 if unknown."""
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(bench, schema, ops, profile=None):
+    """Run a benchmark and return a dictionary of results.
+
+    If profile is given, the run is profiled with that sample rate,
+    and the report is included as 'profile'.
+    """
+    state = None
+    if bench.setup:
+        state = bench.setup(schema, ops)
+    connection = schema.connection
+    connection.resetStats()
+    profiler = None
+    if profile:
+        profiler = forgetSQL.profile(profile).start()
+    startRSS = residentKiB()
+    start = time.time()
+    done = bench.run(schema, ops, state)
+    elapsed = time.time() - start
+    if profiler:
+        profiler.stop()
+    if bench.teardown:
+        bench.teardown(state)
+    result = {}
+    result['ops'] = done
+    result['seconds'] = elapsed
+    result['opsPerSec'] = elapsed and done / elapsed or 0.0
+    result['queries'] = connection.queries
+    result['stats'] = connection.stats
+    result['peakKiB'] = max(0, peakKiB() - startRSS)
+    if profiler:
+        result['profile'] = profiler.report()
+    return result
+
+def runIsolated(bench, schema, ops, profile=None):
+    """Run the benchmark in a forked child to isolate peak memory.
+
+    Falls back to running in-process where fork() is unavailable.
+    """
+    if not hasattr(os, 'fork') or json is None:
+        return measure(bench, schema, ops, profile)
+    (read, write) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            result = measure(bench, schema, ops, profile)
+            os.write(write, json.dumps(result))
+        finally:
+            os._exit(0)
+    os.close(write)
+    data = []
+    while True:
+        chunk = os.read(read, 4096)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(read)
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError("Benchmark %s failed" % bench.name)
+    return json.loads(''.join(data))
+
+def runAll(schema, ops, names=None, repeat=1, profile=None):
+    results = {}
+    for bench in BENCHMARKS:
+        if names and bench.name not in names:
+            continue
+        best = None
+        for i in range(repeat):
+            result = runIsolated(bench, schema, ops, profile)
+            if best is None or result['opsPerSec'] > best['opsPerSec']:
+                best = result
+        results[bench.name] = best
+    return results
+
+def report(results, baseline=None, threshold=10.0, out=sys.stdout):
+    """Print a report, return the names of regressed benchmarks."""
+    regressions = []
+    header = "%-24s %9s %12s %9s %9s %10s" % ('benchmark', 'ops',
+             'ops/sec', 'queries', 'q/op', 'peak KiB')
+    if baseline:
+        header += " %9s" % 'change'
+    print >>out, header
+    print >>out, '-' * len(header)
+    for bench in BENCHMARKS:
+        if not results.has_key(bench.name):
+            continue
+        result = results[bench.name]
+        perOp = result['ops'] and float(result['queries']) / result['ops']
+        line = "%-24s %9d %12.1f %9d %9.2f %10d" % (bench.name,
+               result['ops'], result['opsPerSec'], result['queries'],
+               perOp, result['peakKiB'])
+        if baseline and baseline.has_key(bench.name):
+            old = baseline[bench.name]
+            change = 0.0
+            if old['opsPerSec']:
+                change = (result['opsPerSec'] - old['opsPerSec']) * 100.0 \
+                         / old['opsPerSec']
+            line += " %+8.1f%%" % change
+            if change < -threshold or result['queries'] > old['queries']:
+                line += "  REGRESSION"
+                regressions.append(bench.name)
+        print >>out, line
+    return regressions
+
+
+def main():
+    from optparse import OptionParser
+    usage = """usage: %prog [options] [benchmark ...]
+Benchmarks forgetSQL against an in-process SQLite stand-in."""
+    parser = OptionParser(usage=usage)
+    parser.add_option("-r", "--rows", dest="rows", default="10k",
+                      help="rows in the shop table, like 1k, 100k, 10M "
+                           "[default: %default]")
+    parser.add_option("-n", "--ops", dest="ops", default="2000",
+                      help="operations per benchmark [default: %default]")
+    parser.add_option("--repeat", dest="repeat", type="int", default=3,
+                      help="best of REPEAT runs [default: %default]")
+    parser.add_option("-f", "--file", dest="file", default=":memory:",
+                      help="SQLite database file [default: in memory]")
+    parser.add_option("-s", "--save", dest="save", metavar="FILE",
+                      help="save results as JSON to FILE")
+    parser.add_option("-c", "--compare", dest="compare", metavar="FILE",
+                      help="compare with results saved in FILE")
+    parser.add_option("-t", "--threshold", dest="threshold", type="float",
+                      default=10.0,
+                      help="ops/sec change in percent counted as a "
+                           "regression [default: %default]")
+    parser.add_option("-p", "--profile", dest="profile", type="float",
+                      metavar="SAMPLE",
+                      help="profile the benchmarks, timing SAMPLE (0.0 to "
+                           "1.0) of the operations, and print where the "
+                           "time went. Slows down the benchmarks")
+    parser.add_option("-l", "--list", dest="list", action="store_true",
+                      help="list benchmarks and exit")
+    (options, args) = parser.parse_args()
+
+    if options.list:
+        for bench in BENCHMARKS:
+            print "%-24s %s" % (bench.name, bench.description)
+        return 0
+
+    rows = parseSize(options.rows)
+    ops = parseSize(options.ops)
+    start = time.time()
+    connection = StandInConnection(options.file)
+    schema = Schema(connection, rows)
+    print >>sys.stderr, "Generated %d rows in %.1f seconds" % (
+          rows * 5 + schema.chains, time.time() - start)
+
+    results = runAll(schema, ops, args, options.repeat, options.profile)
+    baseline = None
+    if options.compare:
+        baseline = json.load(open(options.compare))['results']
+    regressions = report(results, baseline, options.threshold)
+    if options.profile:
+        for bench in BENCHMARKS:
+            if results.has_key(bench.name):
+                print
+                print "Profile of %s:" % bench.name
+                print results[bench.name]['profile'],
+    if options.save:
+        saved = {'rows': rows, 'ops': ops, 'results': results}
+        json.dump(saved, open(options.save, 'w'), indent=1)
+    if regressions:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
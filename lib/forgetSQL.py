@@ -35,12 +35,39 @@ import types
 import sys
 import weakref
 import pprint
+import itertools
+import random
 
 try:
     from mx import DateTime
 except:
     DateTime = None
 
+try:
+    import datetime
+except ImportError:
+    datetime = None
+
+try:
+    import decimal
+except ImportError:
+    decimal = None
+
+try:
+    import json
+except ImportError:
+    # Python older than 2.6
+    json = None
+
+try:
+    import threading
+    _local = threading.local()
+except (ImportError, AttributeError):
+    # No threads, or Python older than 2.4
+    class _Local(object):
+        pass
+    _local = _Local()
+
 try:
     True,False
 except NameError:
@@ -51,6 +78,241 @@ class NotFound(exceptions.Exception):
     pass
 
 
+def _isString(value):
+    return type(value) in (types.StringType, types.UnicodeType)
+
+def _isPair(clause):
+    """Is clause a (sql, params) where clause?"""
+    return (type(clause) in (types.TupleType, types.ListType) and
+            len(clause) == 2 and _isString(clause[0]) and
+            type(clause[1]) in (types.TupleType, types.ListType))
+
+
+class Codec(object):
+    """Converts the values of a field between Python and the database.
+
+    toSQL() returns what the database module should store for a value,
+    fromSQL() the Python value for what the database module returned.
+    Both are given None for SQL NULL. This codec leaves all values as
+    they are. Subclass it for other conversions, and name it in
+    Forgetter._codecs to use it in _sqlTypes.
+    """
+    def toSQL(self, value):
+        return value
+
+    def fromSQL(self, value):
+        return value
+
+
+class BooleanCodec(Codec):
+    """Booleans, stored as 't' and 'f'."""
+    def toSQL(self, value):
+        if value is None:
+            return None
+        return value and 't' or 'f'
+
+    def fromSQL(self, value):
+        if value is None:
+            return None
+        if type(value) in types.StringTypes:
+            return value.lower() in ('t', 'true', 'y', 'yes', '1')
+        return value and True or False
+
+
+# ISO 8601 dates and times, as returned by databases without a date
+# type, like SQLite. Times may have an offset from UTC, like +02:00.
+_isoDateTime = re.compile(r"(\d{4})-(\d\d)-(\d\d)"
+                          r"(?:[ T](\d\d):(\d\d)(?::(\d\d)(?:\.(\d+))?)?"
+                          r"(Z|[+-]\d\d(?::?\d\d)?)?)?$")
+_isoTime = re.compile(r"(\d\d):(\d\d)(?::(\d\d)(?:\.(\d+))?)?"
+                      r"(Z|[+-]\d\d(?::?\d\d)?)?$")
+
+if datetime:
+    class _UTCOffset(datetime.tzinfo):
+        """A fixed offset from UTC, in minutes"""
+        def __init__(self, minutes):
+            self._offset = datetime.timedelta(minutes=minutes)
+            sign = minutes < 0 and '-' or '+'
+            self._name = '%s%02d:%02d' % ((sign,) + divmod(abs(minutes), 60))
+
+        def utcoffset(self, dt):
+            return self._offset
+
+        def dst(self, dt):
+            return datetime.timedelta(0)
+
+        def tzname(self, dt):
+            return self._name
+
+        def __repr__(self):
+            return '<UTC%s>' % self._name
+
+def _isoOffset(text):
+    """The tzinfo of an ISO 8601 offset from UTC, or None"""
+    if not text:
+        return None
+    if text == 'Z':
+        return _UTCOffset(0)
+    digits = text[1:].replace(':', '')
+    minutes = int(digits[:2]) * 60 + int(digits[2:] or 0)
+    if text[0] == '-':
+        minutes = -minutes
+    return _UTCOffset(minutes)
+
+def _isoNumbers(match, text):
+    """The numbers of a _isoDateTime or _isoTime match, microseconds
+    and then the tzinfo (or None) last"""
+    if match is None:
+        raise ValueError, "Not in ISO 8601 format: %r" % text
+    numbers = list(match.groups())
+    offset = numbers.pop()
+    fraction = numbers.pop()
+    numbers = [int(number or 0) for number in numbers]
+    numbers.append(int((fraction or '0')[:6].ljust(6, '0')))
+    numbers.append(_isoOffset(offset))
+    return numbers
+
+class DateTimeCodec(Codec):
+    """datetime.datetime, stored in ISO 8601 format.
+
+    Values with a tzinfo are stored with their offset from UTC, and
+    loaded with a fixed offset."""
+    def toSQL(self, value):
+        if value is None or type(value) in types.StringTypes:
+            return value
+        return value.isoformat(' ')
+
+    def fromSQL(self, value):
+        if type(value) not in types.StringTypes:
+            return value
+        return datetime.datetime(*_isoNumbers(
+                                 _isoDateTime.match(value.strip()), value))
+
+
+class DateCodec(Codec):
+    """datetime.date, stored in ISO 8601 format."""
+    def toSQL(self, value):
+        if value is None or type(value) in types.StringTypes:
+            return value
+        return value.isoformat()
+
+    def fromSQL(self, value):
+        if isinstance(value, datetime.datetime):
+            return value.date()
+        if type(value) not in types.StringTypes:
+            return value
+        return datetime.date(*_isoNumbers(
+                             _isoDateTime.match(value.strip()), value)[:3])
+
+
+class TimeCodec(Codec):
+    """datetime.time, stored in ISO 8601 format, with the offset from
+    UTC like DateTimeCodec."""
+    def toSQL(self, value):
+        if value is None or type(value) in types.StringTypes:
+            return value
+        return value.isoformat()
+
+    def fromSQL(self, value):
+        if type(value) not in types.StringTypes:
+            return value
+        return datetime.time(*_isoNumbers(_isoTime.match(value.strip()),
+                                          value))
+
+
+class DecimalCodec(Codec):
+    """decimal.Decimal, stored as a string to keep all digits."""
+    def toSQL(self, value):
+        if value is None or type(value) in types.StringTypes:
+            return value
+        return str(value)
+
+    def fromSQL(self, value):
+        if value is None or isinstance(value, decimal.Decimal):
+            return value
+        if type(value) is types.FloatType:
+            # repr() gives the shortest string for the same float
+            return decimal.Decimal(repr(value))
+        return decimal.Decimal(str(value))
+
+
+class MxDateTimeCodec(Codec):
+    """mx.DateTime values, stored as strings.
+
+    Database modules like psycopg 1 don't accept their own return
+    type."""
+    def toSQL(self, value):
+        if DateTime and type(value) == DateTime.DateTimeDeltaType:
+            # Format delta as days, hours, minutes seconds
+            # NOTE: includes value.second directly to get the
+            # whole floating number
+            return value.strftime("%d %H:%M:") + str(value.second)
+        if value is None:
+            return None
+        return str(value)
+
+
+class ReferenceCodec(Codec):
+    """References to other objects, stored as their ID.
+
+    New objects will be saved first. IDs from the database become
+    (not loaded) instances of userClass, if given. (Forgetter keeps
+    the ID when loading, and calls fromSQL() on first access.)
+    """
+    def __init__(self, userClass=None):
+        self.userClass = userClass
+
+    def toSQL(self, value):
+        if not isinstance(value, Forgetter):
+            return value
+        if value._new:
+            # It's a new object too, it must be saved!
+            value.save()
+        id = value._getID()
+        if len(id) <> 1:
+            raise ValueError, \
+                  "Can't reference multiple-primary-key: %r" % value
+        return id[0]
+
+    def fromSQL(self, value):
+        if value and self.userClass is not None:
+            # create an instance
+            return self.userClass(value)
+        return value
+
+
+class _ValueCodec(Codec):
+    """Chooses the codec by the type of each value, for fields without
+    a type. The codec of each type is looked up once in typeCodecs,
+    including for subclasses."""
+    def __init__(self, typeCodecs):
+        self.typeCodecs = typeCodecs
+        self.resolved = {type(None): None}
+
+    def _resolve(self, valueType):
+        codec = None
+        for base in getattr(valueType, '__mro__', (valueType,)):
+            if self.typeCodecs.has_key(base):
+                codec = self.typeCodecs[base]
+                break
+            if base is Forgetter:
+                codec = _referenceCodec
+                break
+        self.resolved[valueType] = codec
+        return codec
+
+    def toSQL(self, value):
+        try:
+            codec = self.resolved[type(value)]
+        except KeyError:
+            codec = self._resolve(type(value))
+        if codec is None:
+            return value
+        return codec.toSQL(value)
+
+_referenceCodec = ReferenceCodec()
+
+
 class Forgetter(object):
     """SQL to object database wrapper.
 
@@ -102,18 +364,52 @@ class Forgetter(object):
         # Include SQL where-statements in selections
         myIDs = User.getAllIDs(("name='soiland'", 'salary > 5'))
 
+        # or with parameters bound by the database module
+        myIDs = User.getAllIDs([("name=%s", ('soiland',)), 'salary > 5'])
+
 
     Requirements:
 
     The attributes 'cursor' and '_dbModule' should be set from the
     outside.  The cursor should be DB 2.0 complient, preferably with
-    autocommit turned on. (Transactions are not within the scope of this
-    module yet)
+    autocommit turned on. Use transaction() to run several operations
+    in one transaction.
 
     Python 2.2 (iterators, methodclasses)
     """
     # How long to keep objects in cache?
     _timeout = 60
+
+    # A field (as in _sqlFields) with a version number or timestamp
+    # that changes whenever the row is updated, like 'updated'. If set,
+    # cached objects older than _timeout are not thrown away, but
+    # checked against the database with revalidate(), and only reloaded
+    # if their version has changed.
+    _sqlVersion = None
+
+    # For small lookup tables, like countries or statuses: If True, the
+    # whole table is loaded with one query on first use, and kept in
+    # memory. MyClass(id) will then return the preloaded object without
+    # any database access, also when resolving _userClasses. The table
+    # is loaded again after _preloadTimeout seconds, or after it has
+    # been changed through this class.
+    _preload = False
+    _preloadTimeout = 3600
+    # Fields (as in _sqlFields) to index preloaded objects by, for
+    # getPreloaded(), ie. ('code',)
+    _preloadKeys = ()
+
+    # Unique fields (as in _sqlFields) other than _sqlPrimary, like
+    # ('email', 'code'). A tuple of fields can be given for keys of
+    # several fields. Objects can then be found with getBy(), which
+    # remembers the ID for each key value of loaded objects, so that
+    # repeated lookups of cached objects don't use the database.
+    _sqlUnique = ()
+    # Entries for objects no longer cached are removed from the index
+    # of each key when it grows past this many, or twice its size after
+    # the last removal.
+    _uniqueIndexSize = 1000
+
     # Will be True once prepare() is called
     _prepared = False
 
@@ -160,8 +456,23 @@ class Forgetter(object):
     #    _sqlLinks = (
     #        ('shop_id', 'address.shop_id'),
     #    )
+    # A third element can give the kind of JOIN for the table,
+    # ie. ('shop_id', 'address.shop_id', 'LEFT')
     _sqlLinks = ()
 
+    # If set to 'INNER' or 'LEFT', the linked tables are selected with
+    # explicit JOINs of that kind (unless given in _sqlLinks), starting
+    # from _sqlTable, instead of listing the tables and linking them in
+    # WHERE.
+    _sqlJoin = None
+
+    # If True, save() writes the fields of the tables linked directly to
+    # _sqlTable in _sqlLinks as well. Linked rows are found by their
+    # link column, and inserted if missing. Outside transaction(), the
+    # tables are written in a transaction of their own (in autocommit
+    # mode, with BEGIN), sending the writes together at the end.
+    _saveLinks = False
+
     # The name of the sequence used by _nextSequence
     # - if None, a guess will be made based on _sqlTable
     # and _sqlPrimary.
@@ -178,10 +489,11 @@ class Forgetter(object):
     # neccessary need to be a subclass of Forgetter)
     #
     # This means that the attribute will be an instance of that
-    # class, not the ID. The object will not be loaded from the
-    # database until you try to read any of it's attributes,
-    # though. (to prevent unneccessary database overload and
-    # recursions)
+    # class, not the ID. The instance is not created before the
+    # attribute is first read, and the object will not be loaded
+    # from the database until you try to read any of it's
+    # attributes, though. (to prevent unneccessary database
+    # overload and recursions)
     #
     # Notice that _userClasses must be a name resolvable, ie.
     # from the same module as your other classes.
@@ -223,6 +535,33 @@ class Forgetter(object):
             raise "cursor method undefined, no database connection could be made"
     cursor = classmethod(cursor)
 
+    def _cursor(cls, flush=True):
+        """Return a cursor for running statements.
+
+        Inside a transaction() the cursor is on its connection, and
+        writes queued in the transaction are sent first, unless flush
+        is false. Otherwise it is from cursor().
+        """
+        transaction = _currentTransaction()
+        if transaction is None:
+            return cls.cursor()
+        if flush:
+            transaction.flush()
+        return transaction.connection.cursor()
+
+    _cursor = classmethod(_cursor)
+
+    def _queueWrite(self, operation, params):
+        """Queue the statement of operation in the current transaction.
+
+        Returns False, and queues nothing, outside transactions.
+        """
+        transaction = _currentTransaction()
+        if transaction is None:
+            return False
+        transaction.write(self, self._getStatement(operation)[0], params)
+        return True
+
     # a reference to the database module object used, ie.
     # MySQLdb, psycopg etc.
     # Use MyClass._dbModule = MySQLdb - not "MySQLdb"
@@ -236,32 +575,330 @@ class Forgetter(object):
     # compatibility, autosave is on.
     _autosave = True
 
+    # Use server side prepared statements for load(), save() and
+    # delete(). The statements are prepared once per connection, and
+    # executed by name afterwards, so that the database only parses and
+    # plans them once. This requires that the cursor has a 'connection'
+    # attribute (a common DB-API extension). If the database does not
+    # support preparing, the ordinary statements are used instead.
+    #
+    # Forgetter prepares using PostgreSQL's PREPARE/EXECUTE, on
+    # connections from the modules in _prepareModules.
+    _prepareStatements = False
+
+    # Database modules (by top level package) whose connections are
+    # to PostgreSQL, and can PREPARE statements.
+    _prepareModules = ('psycopg2', 'psycopg', 'pgdb', 'pyPgSQL', 'pg8000')
+
+    # How bulkInsert() writes rows:
+    #   'copy'         PostgreSQL's COPY FROM STDIN, requires a cursor
+    #                  with copy_from(), like psycopg2's
+    #   'values'       multi-row INSERT ... VALUES (...), (...)
+    #   'executemany'  cursor.executemany() with the ordinary INSERT
+    # If None, 'copy' is used if the cursor supports it, otherwise
+    # 'values'.
+    _bulkInsertMode = None
+
+    # If True, saving a new object that already has an ID will insert it
+    # or update the existing row with that ID in one statement (ie. an
+    # "upsert"), instead of failing on the duplicate key. Also the
+    # default for bulkInsert(). Requires PostgreSQL 9.5 or later for
+    # Forgetter.
+    _upsert = False
+
+    # Cache the results of getAllIDs(), getAllText() and so getAll()
+    # for this many seconds, for lists like drop-down menus that are
+    # fetched over and over with the same where and orderBy. The cached
+    # results are forgotten when any class writes to one of the tables
+    # in _tables through save(), delete(), bulkInsert(), updateWhere()
+    # or deleteWhere(), but not when the tables are changed by others.
+    # 0 disables the cache.
+    _resultTimeout = 0
+    # Approximate memory in bytes for the cached results of this class,
+    # the oldest results are forgotten first.
+    _resultMemory = 1024 * 1024
+
+    # Types of fields (as in _sqlFields) that need converting between
+    # Python and the database, named as in _codecs, ie.
+    # {'created': 'datetime', 'price': 'decimal', 'active': 'boolean'}
+    # Fields in _userClasses are references, other fields are converted
+    # by the type of the value when saved (see _typeCodecs), and to
+    # booleans when loaded if the cursor says the column is a BOOLEAN.
+    _sqlTypes = {}
+
+    # The codecs that can be named in _sqlTypes. Subclasses may add
+    # their own, ie. _codecs = dict(Forgetter._codecs, money=Money())
+    _codecs = {
+        'boolean': BooleanCodec(),
+        'datetime': DateTimeCodec(),
+        'date': DateCodec(),
+        'time': TimeCodec(),
+        'decimal': DecimalCodec(),
+        'mxDateTime': MxDateTimeCodec(),
+        'raw': Codec(),
+    }
+
+    # Codecs for saving values of fields not in _sqlTypes, by the type
+    # of the value (including subclasses). References to other objects
+    # are stored as their ID, and values of other types as they are.
+    _typeCodecs = {bool: _codecs['boolean']}
+    if datetime:
+        _typeCodecs[datetime.datetime] = _codecs['datetime']
+        _typeCodecs[datetime.date] = _codecs['date']
+        _typeCodecs[datetime.time] = _codecs['time']
+    if decimal:
+        _typeCodecs[decimal.Decimal] = _codecs['decimal']
+    if DateTime:
+        _typeCodecs[DateTime.DateTimeType] = _codecs['mxDateTime']
+        _typeCodecs[DateTime.DateTimeDeltaType] = _codecs['mxDateTime']
+
     def __new__(cls, *args):
         if not hasattr(cls, '_cache'):
             cls._cache = {}
-        try: # to implement 'goto' in Python.. UGH
-            if not cls._cache.has_key(args):
-                # unknown
-                raise "NotFound"
-            (ref, updated) = cls._cache[args]
-            realObject = ref()
-            if realObject is None:
-                # No more real references to it, dead object
-                raise "NotFound"
-            age = time.time() - updated
-            if age > cls._timeout:
-                # Too old!
-                raise "NotFound"
-            updated = time.time()
-        except "NotFound":
+        if not args:
+            # A new object, can't be in the cache
+            return object.__new__(cls)
+        transaction = _currentTransaction()
+        if transaction is not None:
+            realObject = transaction.objects.get((cls, args))
+            if realObject is not None:
+                id = [realObject.__dict__.get(key) for key in cls._sqlPrimary]
+                if id == list(args):
+                    realObject.__dict__['_reused'] = True
+                    return realObject
+                # Deleted or loaded with another ID since
+                del transaction.objects[(cls, args)]
+        if cls._preload and not cls.__dict__.get('_preloading'):
+            realObject = cls._getPreloaded()[1].get(args)
+            if realObject is not None:
+                realObject.__dict__['_reused'] = True
+                return realObject
+        realObject = cls._cached(args)
+        if realObject is None:
             # We'll need to create it
-            realObject = object.__new__(cls, *args)
-            ref = weakref.ref(realObject)
+            realObject = object.__new__(cls)
+        else:
+            # Already initialized, tell __init__
+            realObject.__dict__['_reused'] = True
+        ref = weakref.ref(realObject)
         updated = time.time()
         # store a weak reference
         cls._cache[args] = (ref, updated)
+        if transaction is not None:
+            transaction._seen(cls, args, realObject)
+        return realObject
+
+    def _cached(cls, args):
+        """Return the cached object for args, or None.
+
+        Objects older than _timeout are revalidated first if
+        _sqlVersion is set, otherwise they are too old.
+        """
+        if not cls._cache.has_key(args):
+            return None
+        (ref, updated) = cls._cache[args]
+        # Might be None if there are no more real references
+        # to it (dead object)
+        realObject = ref()
+        if realObject is None:
+            return None
+        id = [realObject.__dict__.get(key) for key in cls._sqlPrimary]
+        if id <> list(args):
+            # Deleted or loaded with another ID since
+            return None
+        age = time.time() - updated
+        if age > cls._timeout:
+            if not cls._sqlVersion:
+                # Too old!
+                return None
+            if not isinstance(realObject, cls) or realObject._changed:
+                # Skipped by revalidate(), don't check the others
+                return None
+            # Check all the old ones while we're at it
+            cls.revalidate()
+            if not cls._cache.has_key(args):
+                # Deleted
+                return None
+            (ref, updated) = cls._cache[args]
+            if time.time() - updated > cls._timeout:
+                return None
         return realObject
 
+    _cached = classmethod(_cached)
+
+    def preload(cls):
+        """Load the whole table into memory now, see _preload.
+
+        The preloaded objects are indexed by their ID, and by each of
+        the _preloadKeys. The index is replaced, not changed, so a
+        preload while others are using the index is safe.
+        """
+        loadedAt = time.time()
+        byID = {}
+        byKey = {}
+        for field in cls._preloadKeys:
+            byKey[field] = {}
+        # Don't look for preloaded objects while we're making them
+        cls._preloading = True
+        try:
+            for object in cls.getAllIterator():
+                byID[tuple(object._getID())] = object
+                for (field, index) in byKey.items():
+                    index[object._referenceID(field)] = object
+        finally:
+            cls._preloading = False
+        cls._preloaded = (loadedAt, byID, byKey)
+        return cls._preloaded
+
+    preload = classmethod(preload)
+
+    def _getPreloaded(cls):
+        """Return (loadedAt, byID, byKey), preloading if needed"""
+        preloaded = cls.__dict__.get('_preloaded')
+        if (preloaded is None or
+            time.time() - preloaded[0] > cls._preloadTimeout):
+            preloaded = cls.preload()
+        return preloaded
+
+    _getPreloaded = classmethod(_getPreloaded)
+
+    def getPreloaded(cls, **keys):
+        """Return the preloaded object with the given key value.
+
+        The key must be one of _preloadKeys, like
+        Country.getPreloaded(code='NO'). Raises NotFound if there is
+        no such object.
+        """
+        if len(keys) <> 1:
+            raise TypeError, "getPreloaded() takes exactly one key"
+        ((field, value),) = keys.items()
+        if isinstance(value, Forgetter):
+            # References are indexed by ID
+            value = value._getID()[0] # assuming single-primary !
+        byKey = cls._getPreloaded()[2]
+        if not byKey.has_key(field):
+            raise ValueError, "%s is not in _preloadKeys" % field
+        try:
+            return byKey[field][value]
+        except KeyError:
+            raise NotFound, keys
+
+    getPreloaded = classmethod(getPreloaded)
+
+    def revalidate(cls, chunk=500):
+        """Check cached objects older than _timeout against the database.
+
+        Requires _sqlVersion. The versions of all such objects are
+        fetched with one query for each ``chunk`` of objects. Objects
+        with an unchanged version are kept in the cache as if they were
+        just loaded, changed ones are reloaded with one query, and
+        deleted ones are removed from the cache. Objects with unsaved
+        changes are left alone.
+
+        This is done automatically when an old object is requested, but
+        may also be called regularly to keep the cache fresh.
+        """
+        now = time.time()
+        cache = getattr(cls, '_cache', {})
+        check = {}
+        for (key, (ref, updated)) in cache.items():
+            object = ref()
+            if object is None:
+                # Dead, might as well clean up
+                del cache[key]
+                continue
+            if (now - updated <= cls._timeout or
+                not isinstance(object, cls) or object._changed):
+                continue
+            if not object._updated:
+                # Not loaded, nothing to check
+                cache[key] = (ref, now)
+                continue
+            check[tuple(object._getID())] = (key, object)
+        ids = check.keys()
+        selectfields = list(cls._sqlPrimary) + [cls._sqlVersion]
+        for start in range(0, len(ids), chunk):
+            chunkIDs = ids[start:start+chunk]
+            (where, params) = cls._splitWhere(cls._idsWhere(chunkIDs))
+            (sql, fields) = cls._prepareSQL("SELECTALL", where, selectfields,
+                                            orderBy=())
+            curs = cls._cursor()
+            cls._execute(curs, sql, params)
+            rows = curs.fetchall()
+            codecs = cls._loadCodecs(fields, curs)
+            curs.close()
+            idPositions = [fields.index(key) for key in cls._sqlPrimary]
+            versionPosition = fields.index(cls._sqlVersion)
+            # Compare the version as loaded
+            versionCodec = codecs[versionPosition]
+            found = {}
+            changed = []
+            for row in rows:
+                id = tuple([row[position] for position in idPositions])
+                if not check.has_key(id):
+                    continue
+                found[id] = True
+                (key, object) = check[id]
+                cache[key] = (weakref.ref(object), now)
+                version = row[versionPosition]
+                if versionCodec is not None:
+                    version = versionCodec.fromSQL(version)
+                if object._values[cls._sqlVersion] <> version:
+                    changed.append(object)
+            for id in chunkIDs:
+                if not found.has_key(id):
+                    # Deleted, or at least not found by this ID
+                    (key, object) = check[id]
+                    del cache[key]
+                    object._updated = None
+            if changed:
+                cls._reload(changed)
+
+    revalidate = classmethod(revalidate)
+
+    def _reload(cls, objects):
+        """Load the given objects with one query."""
+        byID = {}
+        for object in objects:
+            byID[tuple(object._getID())] = object
+        (where, params) = cls._splitWhere(cls._idsWhere(byID.keys()))
+        (sql, fields) = cls._prepareSQL("SELECTALL", where, orderBy=())
+        curs = cls._cursor()
+        fetchedAt = time.time()
+        cls._execute(curs, sql, params)
+        codecs = cls._loadCodecs(fields, curs)
+        idPositions = [fields.index(key) for key in cls._sqlPrimary]
+        for row in curs.fetchall():
+            id = tuple([row[position] for position in idPositions])
+            object = byID.pop(id, None)
+            if object is not None:
+                object._loadFromRow(row, fields, curs, codecs)
+                object._updated = fetchedAt
+        curs.close()
+        for object in byID.values():
+            # Gone, load again (and fail) on next access
+            object._updated = None
+
+    _reload = classmethod(_reload)
+
+    def _idsWhere(cls, ids):
+        """Return a (sql, params) where clause matching any of ids.
+
+        ids should be a list of tuples, following _sqlPrimary.
+        """
+        columns = [cls._sqlFields[key] for key in cls._sqlPrimary]
+        params = []
+        for id in ids:
+            params.extend(id)
+        if len(columns) == 1:
+            marks = ', '.join(('%s',) * len(ids))
+            return ("%s IN (%s)" % (columns[0], marks), params)
+        group = '(' + ', '.join(('%s',) * len(columns)) + ')'
+        marks = ', '.join((group,) * len(ids))
+        return ("(%s) IN (%s)" % (', '.join(columns), marks), params)
+
+    _idsWhere = classmethod(_idsWhere)
+
     def __init__(self, *id):
         """Initialize, possibly with a database id.
 
@@ -269,7 +906,13 @@ class Forgetter(object):
         than 1 in length), may be initalized by using several parameters
         to this constructor.  Note that the object will not be loaded
         before you call load().
+
+        Objects returned from the cache are already initialized, and
+        are not reset.
         """
+        if self.__dict__.has_key('_reused'):
+            del self.__dict__['_reused']
+            return
         self._values = {}
         self.reset()
         if not id:
@@ -336,7 +979,15 @@ class Forgetter(object):
         if self._sqlFields.has_key(key):
             if not self._updated:
                 self.load()
-            return self._values[key]
+            value = self._values[key]
+            if value and self._userClasses.has_key(key):
+                codec = self._fieldCodec(key)
+                # A type in _sqlTypes wins over _userClasses
+                if (isinstance(codec, ReferenceCodec) and
+                    not isinstance(value, codec.userClass)):
+                    # Loaded as an ID, create the instance now
+                    value = self._values[key] = codec.fromSQL(value)
+            return value
         else:
             raise AttributeError, key
 
@@ -432,30 +1083,72 @@ class Forgetter(object):
             (self._validID() and self._changed) or
             (self._updated and self._changed > self._updated) ):
             # Don't save if we have not loaded existing data!
-            self._saveDB()
+            if self._saveLinks and _currentTransaction() is None:
+                self._saveAtomically()
+            else:
+                self._saveDB()
+            if self._saveLinks:
+                self._tablesWritten(self._tables.keys())
+            else:
+                self._tablesWritten()
+            if self._sqlUnique:
+                self._indexUnique()
+            if self._preload:
+                # Load again with the new values
+                self.__class__._preloaded = None
             return True
         return False
 
+    def _saveAtomically(self):
+        """Save all the tables in one transaction, see _saveLinks.
+
+        The writes are queued and sent together at the end. Without a
+        'connection' attribute on the cursor, they are sent one by one.
+        """
+        cursor = self.cursor()
+        connection = getattr(cursor, 'connection', None)
+        cursor.close()
+        if connection is None:
+            self._saveDB()
+            return
+        # In autocommit mode, like otherwise expected
+        transaction = Transaction(connection, begin=True).start()
+        try:
+            self._saveDB()
+        except:
+            transaction.rollback()
+            raise
+        transaction.commit()
+
     def delete(self):
         """Mark this object for deletion in the database.
 
         The object will then be reset and ready for use
         again with a new id.
         """
-        (sql, ) = self._prepareSQL("DELETE")
-        curs = self.cursor()
-        curs.execute(sql, self._getID())
-        curs.close()
+        if not self._queueWrite("DELETE", self._getID()):
+            curs = self._cursor()
+            self._executeStatement(curs, "DELETE", self._getID())
+            curs.close()
+        self._tablesWritten()
+        if self._sqlUnique:
+            self._indexUnique(remove=True)
         self.reset()
+        if self._preload:
+            # Load again without us
+            self.__class__._preloaded = None
 
-    def _prepareSQL(cls, operation="SELECT", where=None, selectfields=None, orderBy=None):
+    def _prepareSQL(cls, operation="SELECT", where=None, selectfields=None, orderBy=None,
+                    limit=None, offset=None):
         """Return a sql for the given operation.
 
         Possible operations:
             SELECT         read data for this id
             SELECTALL    read data for all ids
+            COUNT          count all rows
             INSERT         insert data, create new id
             UPDATE         update data for this id
+            UPSERT         insert data, or update if the id exists
             DELETE         remove data for this id
 
         SQL will be built by data from _sqlFields, and will
@@ -465,9 +1158,10 @@ class Forgetter(object):
             SELECTALL --> 0 %s
             INSERT --> len(cls._sqlFields) %s (including id)
             UPDATE --> len(cls._sqlFields) %s (including id)
+            UPSERT --> len(cls._sqlFields) %s (including id)
             DELETE --> len(cls._sqlPrimary)
 
-        (Note: INSERT and UPDATE will only change values in _sqlTable, so
+        (Note: INSERT, UPSERT and UPDATE will only change values in _sqlTable, so
         the actual number of fields for substitutions might be lower
         than len(cls._sqlFields) )
 
@@ -483,8 +1177,10 @@ class Forgetter(object):
         Return values will always be tuples:
             SELECT --> (sql, fields)
             SELECTALL -> sql, fields)
+            COUNT -> (sql, fields)
             INSERT -> (sql, fields)
             UPDATE -> (sql, fields)
+            UPSERT -> (sql, fields)
             DELETE -> (sql,)    -- for consistency
 
         fields will be object properties as a list, ie. the keys from
@@ -497,19 +1193,25 @@ class Forgetter(object):
         about the order of hash.keys() from time to time, not even with
         the same instance.
 
-        Optional where-parameter applies to SELECT, SELECTALL and DELETE.
-        where should be a list or string of where clauses.
+        The UPSERT conflict clause is given by _upsertClause(), as it
+        depends on the database.
+
+        Optional where-parameter applies to SELECT, SELECTALL, COUNT,
+        UPDATE and DELETE, for UPDATE and DELETE it replaces the primary
+        key condition. where should be a list or string of where
+        clauses. limit and offset apply to SELECTALL only, offset is
+        ignored without limit.
+        Parameters of (sql, params) clauses are not included, use
+        _splitWhere() to retrieve them in the right order.
 
         """
         # Normalize parameter for later comparissions
         operation = operation.upper()
-        # Convert where to a list if it is a string
-        if type(where) in (types.StringType, types.UnicodeType):
-            where = (where,)
+        (where, params) = cls._splitWhere(where)
         if orderBy is None:
             orderBy = cls._orderBy
 
-        if operation in ('SELECT', 'SELECTALL'):
+        if operation in ('SELECT', 'SELECTALL', 'COUNT'):
             # Get the object fields and sql fields in the same
             # order to be able to reconstruct later.
             fields = []
@@ -526,15 +1228,23 @@ Fields asked: %s
 My fields: %s""" % (selectfields, cls._sqlFields)
 
             sql = "SELECT\n    "
-            sql += ', '.join(sqlfields)
+            if operation == 'COUNT':
+                sql += 'COUNT(*)'
+            else:
+                sql += ', '.join(sqlfields)
             sql += "\nFROM\n    "
             tables = cls._tables.keys()
             if not tables:
                 raise "REALITY ERROR: No tables defined"
-            sql += ', '.join(tables)
-            tempWhere = ["%s=%s" % linkPair for linkPair in cls._sqlLinks]
+            if cls._joined():
+                sql += cls._joinSQL()
+                tempWhere = []
+            else:
+                sql += ', '.join(tables)
+                tempWhere = ["%s=%s" % linkPair[:2]
+                             for linkPair in cls._sqlLinks]
             # this MUST be here.
-            if operation <> 'SELECTALL':
+            if operation == 'SELECT':
                 for key in cls._sqlPrimary:
                     tempWhere.append(cls._sqlFields[key] + "=%s")
             if where:
@@ -553,9 +1263,13 @@ My fields: %s""" % (selectfields, cls._sqlFields)
                 else:
                     orderBy = cls._sqlFields[orderBy]
                 sql += orderBy
+            if operation == 'SELECTALL' and limit is not None:
+                sql += '\nLIMIT %d' % limit
+                if offset:
+                    sql += '\nOFFSET %d' % offset
             return (sql, fields)
 
-        elif operation in ('INSERT', 'UPDATE'):
+        elif operation in ('INSERT', 'UPDATE', 'UPSERT'):
             if operation == 'UPDATE':
                 sql = 'UPDATE %s SET\n    ' % cls._sqlTable
             else:
@@ -567,6 +1281,8 @@ My fields: %s""" % (selectfields, cls._sqlFields)
             for (field, sqlfield) in cls._sqlFields.items():
                 if operation == 'UPDATE' and field in cls._sqlPrimary:
                     continue
+                if selectfields is not None and field not in selectfields:
+                    continue
                 if sqlfield.find(cls._sqlTable + '.') == 0:
                     # It's a local field, chop of the table part
                     sqlfield = sqlfield[len(cls._sqlTable)+1:]
@@ -576,23 +1292,28 @@ My fields: %s""" % (selectfields, cls._sqlFields)
             if operation == 'UPDATE':
                 sql += ',\n    '.join(set)
                 sql += '\nWHERE\n    '
-                tempWhere = []
-                for key in cls._sqlPrimary:
-                    tempWhere.append(cls._sqlFields[key] + "=%s")
-                    fields.append(key)
-                sql += ' AND\n    '.join(tempWhere)
+                if where:
+                    sql += '(' + ') AND\n    ('.join(where) + ')'
+                else:
+                    tempWhere = []
+                    for key in cls._sqlPrimary:
+                        tempWhere.append(cls._sqlFields[key] + "=%s")
+                        fields.append(key)
+                    sql += ' AND\n    '.join(tempWhere)
             else:
                 sql += ',\n    '.join(sqlfields)
                 sql += ')\nVALUES (\n    '
                 sql += ',\n    '.join(('%s',) * len(sqlfields))
                 sql += ')'
+                if operation == 'UPSERT':
+                    sql += '\n' + cls._upsertClause(fields)
 
             return (sql, fields)
 
         elif operation == 'DELETE':
             sql = 'DELETE FROM ' + cls._sqlTable + ' WHERE '
             if where:
-                sql += " AND\n    ".join(where)
+                sql += '(' + ') AND\n    ('.join(where) + ')'
             else:
                 for key in cls._sqlPrimary:
                     tempWhere = []
@@ -605,6 +1326,300 @@ My fields: %s""" % (selectfields, cls._sqlFields)
 
     _prepareSQL = classmethod(_prepareSQL)
 
+    def _joined(cls):
+        """Should tables be selected with explicit JOINs?"""
+        if cls._sqlJoin:
+            return True
+        for link in cls._sqlLinks:
+            if len(link) > 2:
+                return True
+        return False
+
+    _joined = classmethod(_joined)
+
+    def _joinSQL(cls):
+        """Return the tables of _tables joined by _sqlLinks.
+
+        Tables are joined in the order they can be reached from
+        _sqlTable, each with an ON of all the links to the tables
+        before it. Tables that can't be reached are CROSS JOINed.
+        """
+        joined = {cls._sqlTable: True}
+        sql = cls._sqlTable
+        remaining = [table for table in cls._tables.keys()
+                     if table <> cls._sqlTable]
+        while remaining:
+            for table in remaining:
+                on = []
+                kind = cls._sqlJoin or 'INNER'
+                for link in cls._sqlLinks:
+                    tables = [column.split('.')[0] for column in link[:2]]
+                    if table in tables:
+                        other = tables[1 - tables.index(table)]
+                        if joined.has_key(other):
+                            on.append("%s=%s" % link[:2])
+                            if len(link) > 2:
+                                kind = link[2].upper()
+                if on:
+                    sql += '\n    %s JOIN %s ON (%s)' % (kind, table,
+                                                       ' AND '.join(on))
+                    break
+            else:
+                # None of them can be reached, just take the first
+                table = remaining[0]
+                sql += '\n    CROSS JOIN %s' % table
+            joined[table] = True
+            remaining.remove(table)
+        return sql
+
+    _joinSQL = classmethod(_joinSQL)
+
+    def _prepareLinkedSQL(cls, table):
+        """Return SQL for saving the fields of a linked table.
+
+        Returns (update, insert, exists, fields, linkField), where update
+        is an UPDATE with %s for fields and then the link value, insert
+        an INSERT with %s for the link value and then fields, exists a
+        SELECT with %s for the link value, returning a row if there is
+        a linked row, and linkField the field in _sqlTable with the
+        link value.
+
+        The table must be linked directly to _sqlTable in _sqlLinks.
+        """
+        linkColumn = None
+        for link in cls._sqlLinks:
+            (first, second) = link[:2]
+            if second.split('.')[0] == table:
+                (first, second) = (second, first)
+            if (first.split('.')[0] == table and
+                second.split('.')[0] == cls._sqlTable):
+                linkColumn = first
+                mainColumn = second
+                break
+        if linkColumn is None:
+            raise ValueError, "%s is not linked to %s" % (table,
+                                                          cls._sqlTable)
+        linkField = None
+        fields = []
+        columns = []
+        for (field, sqlfield) in cls._sqlFields.items():
+            if sqlfield == mainColumn:
+                linkField = field
+            elif sqlfield.split('.')[0] == table and sqlfield <> linkColumn:
+                fields.append(field)
+                columns.append(sqlfield[len(table)+1:])
+        if linkField is None:
+            raise ValueError, "%s is not in _sqlFields" % mainColumn
+        localLink = linkColumn[len(table)+1:]
+        update = 'UPDATE %s SET\n    ' % table
+        update += ',\n    '.join([column + '=%s' for column in columns])
+        update += '\nWHERE\n    %s=%%s' % localLink
+        insert = 'INSERT INTO %s (\n    ' % table
+        insert += ',\n    '.join([localLink] + columns)
+        insert += ')\nVALUES (\n    '
+        insert += ',\n    '.join(('%s',) * (len(columns)+1))
+        insert += ')'
+        exists = 'SELECT 1 FROM %s WHERE %s=%%s' % (table, localLink)
+        return (update, insert, exists, fields, linkField)
+
+    _prepareLinkedSQL = classmethod(_prepareLinkedSQL)
+
+    def _saveLinked(self, new):
+        """Save the fields of linked tables, see _saveLinks.
+
+        Existing linked rows are updated, missing ones (as with a LEFT
+        JOIN) inserted. In a transaction, the statements are queued
+        like the others.
+        """
+        transaction = _currentTransaction()
+        statements = self._getStatement(None)
+        for table in self._tables.keys():
+            if table == self._sqlTable:
+                continue
+            if not statements.has_key(('LINKED', table)):
+                statements[('LINKED', table)] = self._prepareLinkedSQL(table)
+            (update, insert, exists, fields, linkField) = \
+                statements[('LINKED', table)]
+            if not fields:
+                continue
+            values = [self._sqlValue(getattr(self, field), field)
+                      for field in fields]
+            link = self._sqlValue(getattr(self, linkField), linkField)
+            # Check rather than trust rowcount after the UPDATE, which
+            # is the number of changed rows with MySQLdb, not matched
+            if new or not self._linkedExists(table, exists, link):
+                (sql, params) = (insert, [link] + values)
+            else:
+                (sql, params) = (update, values + [link])
+            if transaction is not None:
+                transaction.write(self, sql, params, table)
+            else:
+                cursor = self._cursor()
+                cursor.execute(sql, params)
+                cursor.close()
+
+    def _linkedExists(self, table, exists, link):
+        """Is there a row in the linked table with the link value?"""
+        # Only queued writes to the linked table matter
+        transaction = _currentTransaction()
+        cursor = self._cursor(transaction is not None and
+                              transaction.pending.has_key(table))
+        cursor.execute(exists, (link,))
+        found = cursor.fetchone() is not None
+        cursor.close()
+        return found
+
+    def _upsertClause(cls, fields):
+        """Return the clause making an INSERT of fields an upsert.
+
+        The conflict target is the columns of _sqlPrimary.
+        """
+        primary = []
+        update = []
+        for field in fields:
+            column = cls._sqlFields[field][len(cls._sqlTable)+1:]
+            if field in cls._sqlPrimary:
+                primary.append(column)
+            else:
+                update.append('%s=EXCLUDED.%s' % (column, column))
+        sql = 'ON CONFLICT (%s) DO ' % ', '.join(primary)
+        if not update:
+            return sql + 'NOTHING'
+        return sql + 'UPDATE SET\n    ' + ',\n    '.join(update)
+
+    _upsertClause = classmethod(_upsertClause)
+
+    def _whereList(cls, where):
+        """Normalize where clauses to a list.
+
+        A where clause is either a string with SQL, or a (sql, params)
+        pair where sql contains a %s for each of the values in params.
+        where may be a single clause, or a list of clauses. (A single
+        pair whose params look like a pair themselves, ie.
+        ("a=%s AND b IN %s", ("x", (1, 2))), must be given in a list.)
+        """
+        if where is None:
+            return []
+        if _isString(where):
+            return [where]
+        if _isPair(where) and not _isPair(where[1]):
+            # A single (sql, params) pair
+            return [where]
+        return list(where)
+
+    _whereList = classmethod(_whereList)
+
+    def _splitWhere(cls, where):
+        """Split where clauses into SQL and parameters.
+
+        Returns (clauses, params), where clauses is a list of SQL strings
+        to be AND-ed, and params is a list of values for their %s, in
+        order.
+        """
+        clauses = []
+        params = []
+        for clause in cls._whereList(where):
+            if type(clause) in (types.TupleType, types.ListType):
+                (clause, values) = clause
+                params.extend(values)
+            clauses.append(clause)
+        return (clauses, params)
+
+    _splitWhere = classmethod(_splitWhere)
+
+    def _execute(cls, curs, sql, params=None):
+        """Execute sql on curs, binding params if any.
+
+        Without parameters the sql is executed as is, so that clauses
+        like "name LIKE 'a%'" don't need to escape %.
+        """
+        if params:
+            curs.execute(sql, params)
+        else:
+            curs.execute(sql)
+
+    _execute = classmethod(_execute)
+
+    def _getStatement(cls, operation):
+        """Return _prepareSQL(operation), built once per class.
+
+        Only for operations without additional parameters, ie. SELECT,
+        INSERT, UPDATE, UPSERT and DELETE. If operation is None, the
+        dictionary of statements is returned.
+        """
+        statements = cls.__dict__.get('_statements')
+        if statements is None:
+            statements = cls._statements = {}
+        if operation is None:
+            return statements
+        if not statements.has_key(operation):
+            statements[operation] = cls._prepareSQL(operation)
+        return statements[operation]
+
+    _getStatement = classmethod(_getStatement)
+
+    def _executeStatement(cls, curs, operation, params):
+        """Execute the statement for operation with params on curs.
+
+        If _prepareStatements is set, the statement will be prepared on
+        the cursor's connection the first time, and executed by name
+        afterwards.
+        """
+        sql = cls._getStatement(operation)[0]
+        connection = getattr(curs, 'connection', None)
+        if not cls._prepareStatements or connection is None:
+            curs.execute(sql, params)
+            return
+        names = cls.__dict__.get('_statementNames')
+        if names is None:
+            names = cls._statementNames = {}
+        name = names.get(operation)
+        if name is None:
+            name = _statementName(cls, operation)
+            names[operation] = name
+        prepared = _preparedOn(connection)
+        if not prepared.has_key(name):
+            if not cls._canPrepare(connection):
+                curs.execute(sql, params)
+                return
+            cls._serverPrepare(curs, name, sql)
+            prepared[name] = sql
+        cls._serverExecute(curs, name, params)
+
+    _executeStatement = classmethod(_executeStatement)
+
+    def _canPrepare(cls, connection):
+        """Can statements be prepared on connection?
+
+        Decided by the database module of the connection, as a failed
+        PREPARE would abort the current transaction.
+        """
+        module = type(connection).__module__.split('.')[0]
+        return module in cls._prepareModules
+
+    _canPrepare = classmethod(_canPrepare)
+
+    def _serverPrepare(cls, curs, name, sql):
+        """Prepare sql on the server as the statement name."""
+        # PREPARE wants numbered parameters $1, $2, ...
+        parts = sql.split('%s')
+        numbered = parts[0]
+        for (position, part) in enumerate(parts[1:]):
+            numbered += '$%d' % (position+1) + part
+        curs.execute("PREPARE %s AS %s" % (name, numbered))
+
+    _serverPrepare = classmethod(_serverPrepare)
+
+    def _serverExecute(cls, curs, name, params):
+        """Execute the prepared statement name with params."""
+        if not params:
+            curs.execute("EXECUTE %s" % name)
+            return
+        marks = ', '.join(('%s',) * len(params))
+        curs.execute("EXECUTE %s (%s)" % (name, marks), params)
+
+    _serverExecute = classmethod(_serverExecute)
+
     def _nextSequence(cls, name=None):
         """Return a new sequence number for insertion in self._sqlTable.
 
@@ -613,6 +1628,33 @@ My fields: %s""" % (selectfields, cls._sqlFields)
         key 'john_id', sequence name blapp_john_id_seq) you must give
         the full sequence name as an optional argument to _nextSequence)
         """
+        name = cls._sequenceName(name)
+        curs = cls._cursor(flush=False)
+        curs.execute("SELECT nextval('%s')" % name)
+        value = curs.fetchone()[0]
+        curs.close()
+        return value
+
+    _nextSequence = classmethod(_nextSequence)
+
+    def _nextSequences(cls, count, name=None):
+        """Return a list of count new sequence numbers.
+
+        Like _nextSequence(), but with one query for all of them. Must be
+        overloaded for multi _sqlPrimary classes, returning tuples.
+        """
+        name = cls._sequenceName(name)
+        curs = cls._cursor(flush=False)
+        curs.execute("SELECT nextval('%s') FROM generate_series(1, %d)"
+                     % (name, count))
+        values = [row[0] for row in curs.fetchall()]
+        curs.close()
+        return values
+
+    _nextSequences = classmethod(_nextSequences)
+
+    def _sequenceName(cls, name=None):
+        """Return the sequence name, given name or a guess"""
         if not name:
             name = cls._sqlSequence
         if not name:
@@ -622,45 +1664,145 @@ My fields: %s""" % (selectfields, cls._sqlFields)
             primary = cls._sqlPrimary[0]
             name = '%s_%s_seq' % (cls._sqlTable, primary.replace('.','_'))
             # Don't have . as a tablename or column name! =)
-        curs = cls.cursor()
-        curs.execute("SELECT nextval('%s')" % name)
-        value = curs.fetchone()[0]
-        curs.close()
-        return value
+        return name
 
-    _nextSequence = classmethod(_nextSequence)
+    _sequenceName = classmethod(_sequenceName)
 
-    def _loadFromRow(self, result, fields, cursor):
+    def _loadFromRow(self, result, fields, cursor, codecs=None):
         """Load from a database row, described by fields.
 
         ``fields`` should be the attribute names that
-        will be set. Note that userclasses will be
-        created (but not loaded).
+        will be set. Note that fields in _userClasses are
+        set to the IDs, the instances are created on first
+        access. Values are converted by codecs, as returned
+        by _loadCodecs(fields, cursor).
         """
-        position = 0
-        for elem in fields:
-            value = result[position]
-            valueType = cursor.description[position][1]
-            if hasattr(self._dbModule, 'BOOLEAN') and \
-                       valueType == self._dbModule.BOOLEAN and \
-                       (value is not True or value is not False):
-                # convert to a python boolean
-                value = value and True or False
-            if value and self._userClasses.has_key(elem):
-                userClass = self._userClasses[elem]
-                # create an instance
-                value = userClass(value)
-
-            self._values[elem] = value
-            position += 1
+        if codecs is None:
+            codecs = self._loadCodecs(fields, cursor)
+        values = self._values
+        for (field, value, codec) in zip(fields, result, codecs):
+            if codec is not None:
+                value = codec.fromSQL(value)
+            values[field] = value
+        if self._sqlUnique:
+            self._indexUnique()
+
+    def _uniqueKeys(cls):
+        """Return _sqlUnique with every key as a tuple of fields"""
+        keys = []
+        for key in cls._sqlUnique:
+            if type(key) in (types.StringType, types.UnicodeType):
+                key = (key,)
+            keys.append(tuple(key))
+        return keys
+
+    _uniqueKeys = classmethod(_uniqueKeys)
+
+    def _uniqueIndex(cls, key):
+        """Return the dictionary from values of key to IDs"""
+        indexes = cls.__dict__.get('_uniqueIndexes')
+        if indexes is None:
+            indexes = cls._uniqueIndexes = {}
+            # The sizes to prune each index at, see _indexUnique()
+            cls._uniqueLimits = {}
+        if not indexes.has_key(key):
+            indexes[key] = {}
+        return indexes[key]
+
+    _uniqueIndex = classmethod(_uniqueIndex)
+
+    def _uniqueValue(cls, values, key):
+        """Return the values of the fields of key, as a tuple.
+
+        values is a dictionary like _values. References are replaced
+        by their IDs.
+        """
+        result = []
+        for field in key:
+            value = values[field]
+            if isinstance(value, Forgetter):
+                value = value._getID()[0] # assuming single-primary !
+            result.append(value)
+        return tuple(result)
+
+    _uniqueValue = classmethod(_uniqueValue)
+
+    def _indexUnique(self, remove=False):
+        """Register (or remove) my values of _sqlUnique keys"""
+        id = tuple(self._getID())
+        for key in self._uniqueKeys():
+            index = self._uniqueIndex(key)
+            value = self._uniqueValue(self._values, key)
+            if not remove:
+                index[value] = id
+                limits = self._uniqueLimits
+                if len(index) > limits.get(key, self._uniqueIndexSize):
+                    self._pruneUnique(key, index)
+            elif index.get(value) == id:
+                del index[value]
+
+    def _pruneUnique(cls, key, index):
+        """Remove entries of the index of key whose object is no longer
+        cached, or has other values now"""
+        cache = getattr(cls, '_cache', {})
+        for (value, id) in index.items():
+            entry = cache.get(id)
+            object = entry and entry[0]()
+            if (object is None or
+                cls._uniqueValue(object._values, key) <> value):
+                del index[value]
+        cls._uniqueLimits[key] = max(cls._uniqueIndexSize, 2 * len(index))
+
+    _pruneUnique = classmethod(_pruneUnique)
+
+    def getBy(cls, **keys):
+        """Return the object with the given unique key values.
+
+        The fields given must be one of the keys in _sqlUnique, like
+        User.getBy(email='stain@example.com'). If a cached object is
+        known to have the values, it is returned without any database
+        access. Raises NotFound if there is no such object.
+        """
+        fields = keys.keys()
+        fields.sort()
+        for key in cls._uniqueKeys():
+            sortedKey = list(key)
+            sortedKey.sort()
+            if sortedKey == fields:
+                break
+        else:
+            raise ValueError, "%s is not in _sqlUnique" % fields
+        value = cls._uniqueValue(keys, key)
+        if cls._preload and len(key) == 1 and key[0] in cls._preloadKeys:
+            return cls.getPreloaded(**keys)
+        index = cls._uniqueIndex(key)
+        id = index.get(value)
+        if id is not None:
+            object = cls._cached(id)
+            if (object is not None and object._updated and
+                cls._uniqueValue(object._values, key) == value):
+                return cls(*id)
+            # Changed or gone, ask the database
+            del index[value]
+        where = [(cls._sqlFields[field] + '=%s', (cls._sqlValue(keys[field], field),))
+                 for field in key]
+        objects = list(cls.getAllIterator(where))
+        if not objects:
+            raise NotFound, keys
+        return objects[0]
+
+    getBy = classmethod(getBy)
 
     def _loadDB(self):
         """Connect to the database to load myself"""
         if not self._validID():
             raise NotFound, self._getID()
-        (sql, fields) = self._prepareSQL("SELECT")
-        curs = self.cursor()
-        curs.execute(sql, self._getID())
+        (sql, fields) = self._getStatement("SELECT")
+        # Queued writes to other rows of our class can't change us
+        transaction = _currentTransaction()
+        curs = self._cursor(transaction is None or
+                            transaction.queued(self.__class__, self._getID()))
+        self._executeStatement(curs, "SELECT", self._getID())
         result = curs.fetchone()
         if not result:
             curs.close()
@@ -681,6 +1823,8 @@ My fields: %s""" % (selectfields, cls._sqlFields)
             operation = 'INSERT'
             if not self._validID():
                 self._setID(self._nextSequence())
+            elif self._upsert:
+                operation = 'UPSERT'
             # Note that we assign this ID to our self
             # BEFORE possibly saving any of our attribute
             # objects that might be new as well. This means
@@ -693,51 +1837,398 @@ My fields: %s""" % (selectfields, cls._sqlFields)
             # MysqlForgetter below.
         else:
             operation = 'UPDATE'
-        (sql, fields) = self._prepareSQL(operation)
-        values = []
-        for field in fields:
-            value = getattr(self, field)
-            # First some dirty datatype hacks
-            if DateTime and type(value) == DateTime.DateTimeType:
-                # stupid psycopg does not support it's own return type..
-                # lovely..
-                value = str(value)
-            if DateTime and type(value) == DateTime.DateTimeDeltaType:
-                # Format delta as days, hours, minutes seconds
-                # NOTE: includes value.second directly to get the
-                # whole floating number
-                value = value.strftime("%d %H:%M:") + str(value.second)
-            if value is True or value is False:
-                # We must store booleans as 't' and 'f' ...
-                value = value and 't' or 'f'
-            if isinstance(value, Forgetter):
-                # It's another object, we store only the ID
-                if value._new:
-                    # It's a new object too, it must be saved!
-                    value.save()
-                try:
-                    (value,) = value._getID()
-                except:
-                    raise "Unsupported: Can't reference multiple-primary-key: %s" % value
-            values.append(value)
-        cursor = self.cursor()
-        cursor.execute(sql, values)
-        # cursor.commit()
-        cursor.close()
+        values = [codec.toSQL(getattr(self, field))
+                  for (field, codec) in self._saveCodecs(operation)]
+        if not self._queueWrite(operation, values):
+            cursor = self._cursor()
+            self._executeStatement(cursor, operation, values)
+            # cursor.commit()
+            cursor.close()
+        if self._saveLinks:
+            self._saveLinked(operation == 'INSERT')
         self._new = False
         self._changed = None
 
-    def getAll(cls, where=None, orderBy=None):
+    def _sqlValue(cls, value, field=None):
+        """Convert value to something the database module can store.
+
+        The codec of field (as in _sqlFields) is used if given, otherwise
+        the codec is chosen by the type of value. References to other
+        objects are stored as their ID, new objects will be saved first.
+        """
+        if field is None:
+            return cls._valueCodec().toSQL(value)
+        return cls._fieldCodec(field).toSQL(value)
+
+    _sqlValue = classmethod(_sqlValue)
+
+    def _valueCodec(cls):
+        """The codec choosing conversions by the type of each value"""
+        codec = cls.__dict__.get('_typeCodec')
+        if codec is None:
+            codec = cls._typeCodec = _ValueCodec(cls._typeCodecs)
+        return codec
+
+    _valueCodec = classmethod(_valueCodec)
+
+    def _fieldCodec(cls, field):
+        """The codec of field (as in _sqlFields), resolved once.
+
+        Fields in _sqlTypes use the named codec from _codecs, fields in
+        _userClasses are references, other fields use _valueCodec().
+        """
+        codecs = cls.__dict__.get('_fieldCodecs')
+        if codecs is None:
+            codecs = cls._fieldCodecs = {}
+        codec = codecs.get(field)
+        if codec is None:
+            if cls._sqlTypes.has_key(field):
+                name = cls._sqlTypes[field]
+                if not cls._codecs.has_key(name):
+                    raise ValueError, "Unknown type %r of field %s" % (
+                                      name, field)
+                codec = cls._codecs[name]
+            elif cls._userClasses.has_key(field):
+                codec = ReferenceCodec(cls._userClasses[field])
+            else:
+                codec = cls._valueCodec()
+            codecs[field] = codec
+        return codec
+
+    _fieldCodec = classmethod(_fieldCodec)
+
+    def _saveCodecs(cls, operation):
+        """Return (field, codec) for each field of the statement of
+        operation, see _getStatement(), resolved once."""
+        lists = cls.__dict__.get('_codecLists')
+        if lists is None:
+            lists = cls._codecLists = {}
+        key = ('SAVE', operation)
+        if not lists.has_key(key):
+            fields = cls._getStatement(operation)[1]
+            lists[key] = [(field, cls._fieldCodec(field))
+                          for field in fields]
+        return lists[key]
+
+    _saveCodecs = classmethod(_saveCodecs)
+
+    def _loadCodecs(cls, fields, cursor):
+        """Return the codecs for loading values of fields from the
+        rows of cursor, None where no conversion is needed.
+
+        Resolved once for each list of fields and column types.
+        """
+        boolean = getattr(cls._dbModule, 'BOOLEAN', None)
+        typeCodes = ()
+        if boolean is not None:
+            typeCodes = tuple([column[1] for column in cursor.description])
+        key = (tuple(fields), typeCodes)
+        lists = cls.__dict__.get('_codecLists')
+        if lists is None:
+            lists = cls._codecLists = {}
+        try:
+            return lists[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Type codes we can't use as a key
+            key = None
+        codecs = []
+        for position in range(len(fields)):
+            field = fields[position]
+            if cls._sqlTypes.has_key(field):
+                codecs.append(cls._fieldCodec(field))
+            elif cls._userClasses.has_key(field):
+                # Kept as the ID until accessed, see __getattr__
+                codecs.append(None)
+            elif typeCodes and typeCodes[position] == boolean:
+                # convert to a python boolean
+                codecs.append(cls._codecs['boolean'])
+            else:
+                codecs.append(None)
+        if key is not None:
+            lists[key] = codecs
+        return codecs
+
+    _loadCodecs = classmethod(_loadCodecs)
+
+
+    def bulkInsert(cls, rows, chunk=None, upsert=None):
+        """Insert many new rows, returning their IDs.
+
+        rows is an iterable of dictionaries from field names (as in
+        _sqlFields) to values, or of new objects of this class. Only
+        fields of _sqlTable are inserted, and values are converted like
+        in save(). Rows without an ID get one like in save(), but with
+        one query for each chunk.
+
+        The rows are written ``chunk`` at a time, by the fastest method
+        available, see _bulkInsertMode. By default chunks are as large
+        as possible while staying below 30000 parameters per statement.
+
+        If upsert is true (default: _upsert), rows with an ID that
+        already exists will update the existing row instead, with only
+        the fields given in the row. COPY can't do that, so multi-row
+        INSERT is used instead.
+
+        Returns a list of the IDs of the inserted rows, in order, as
+        tuples for multivalue _sqlPrimary. Objects are marked as saved.
+        """
+        if upsert is None:
+            upsert = cls._upsert
+        (sql, fields) = cls._getStatement("INSERT")
+        if not chunk:
+            chunk = max(1, 30000 / len(fields))
+        known = {}
+        for field in fields:
+            known[field] = True
+        primary = [fields.index(key) for key in cls._sqlPrimary]
+        codecs = [cls._fieldCodec(field) for field in fields]
+        result = []
+        rows = iter(rows)
+        curs = cls._cursor()
+        try:
+            while True:
+                objects = []
+                values = []
+                missing = []
+                # The fields to update if the row exists, for upsert
+                updates = []
+                for row in itertools.islice(rows, chunk):
+                    if isinstance(row, Forgetter):
+                        objects.append(row)
+                        row = [getattr(row, field) for field in fields]
+                        updates.append(tuple(fields))
+                    else:
+                        for field in row.keys():
+                            if not known.has_key(field):
+                                raise ValueError, \
+                                      "Can't insert field: %s" % field
+                        updates.append(tuple([field for field in fields
+                                              if row.has_key(field) or
+                                              field in cls._sqlPrimary]))
+                        row = [row.get(field) for field in fields]
+                    row = [codec.toSQL(value)
+                           for (codec, value) in zip(codecs, row)]
+                    for position in primary:
+                        if row[position] is not None:
+                            break
+                    else:
+                        missing.append(len(values))
+                    values.append(row)
+                if not values:
+                    break
+                if upsert:
+                    cls._bulkUpsertChunk(curs, fields, values, missing,
+                                         updates)
+                else:
+                    cls._bulkInsertChunk(curs, fields, values, missing)
+                ids = []
+                for row in values:
+                    id = [row[position] for position in primary]
+                    if len(id) > 1:
+                        ids.append(tuple(id))
+                    else:
+                        ids.append(id[0])
+                result.extend(ids)
+                updated = time.time()
+                for (object, id) in zip(objects, ids):
+                    object._setID(id)
+                    object._updated = updated
+                    object._changed = None
+        finally:
+            curs.close()
+            cls._tablesWritten()
+            if cls._preload:
+                cls._preloaded = None
+        return result
+
+    bulkInsert = classmethod(bulkInsert)
+
+    def _bulkUpsertChunk(cls, curs, fields, values, missing, updates):
+        """Upsert the rows of values, updating the fields in updates
+        (one list for each row) of existing rows.
+
+        Rows updating the same fields are written together, with
+        _bulkInsertChunk().
+        """
+        isMissing = {}
+        for index in missing:
+            isMissing[index] = True
+        groups = {}
+        order = []
+        for (index, update) in enumerate(updates):
+            if not groups.has_key(update):
+                groups[update] = []
+                order.append(update)
+            groups[update].append(index)
+        for update in order:
+            indexes = groups[update]
+            # The ID values are set in place in the same lists
+            groupValues = [values[index] for index in indexes]
+            groupMissing = [position
+                            for (position, index) in enumerate(indexes)
+                            if isMissing.has_key(index)]
+            cls._bulkInsertChunk(curs, fields, groupValues, groupMissing,
+                                 list(update))
+
+    _bulkUpsertChunk = classmethod(_bulkUpsertChunk)
+
+    def _bulkInsertChunk(cls, curs, fields, values, missing, upsert=False):
+        """Insert the rows of values, a list of lists in fields order.
+
+        missing are the indexes of rows with no ID, their ID values
+        should be set in place. If upsert is true, existing rows should
+        be updated, with only the fields in upsert if it is a list.
+        """
+        if missing:
+            ids = cls._nextSequences(len(missing))
+            primary = [fields.index(key) for key in cls._sqlPrimary]
+            for (index, id) in zip(missing, ids):
+                if len(primary) == 1:
+                    id = (id,)
+                for (position, value) in zip(primary, id):
+                    values[index][position] = value
+        cls._bulkWrite(curs, fields, values, upsert=upsert)
+
+    _bulkInsertChunk = classmethod(_bulkInsertChunk)
+
+    def _bulkWrite(cls, curs, fields, values, mode=None, upsert=False):
+        """Write rows of values with the given or default mode.
+
+        If upsert is true, existing rows are updated, with only the
+        fields in upsert if it is a list.
+        """
+        if upsert and type(upsert) is not types.ListType:
+            upsert = fields
+        if mode is None:
+            mode = cls._bulkInsertMode
+        if mode is None:
+            if hasattr(curs, 'copy_from'):
+                mode = 'copy'
+            else:
+                mode = 'values'
+        if mode == 'copy' and upsert:
+            mode = 'values'
+        if mode == 'copy':
+            columns = [cls._sqlFields[field][len(cls._sqlTable)+1:]
+                       for field in fields]
+            curs.copy_from(_CopyData(values), cls._sqlTable,
+                           columns=columns)
+        elif mode == 'values':
+            (sql, fields) = cls._getStatement("INSERT")
+            group = '(' + ', '.join(('%s',) * len(fields)) + ')'
+            sql = sql[:sql.rindex('VALUES')] + 'VALUES\n    '
+            sql += ',\n    '.join((group,) * len(values))
+            if upsert:
+                sql += '\n' + cls._upsertClause(upsert)
+            params = []
+            for row in values:
+                params.extend(row)
+            curs.execute(sql, params)
+        elif mode == 'executemany':
+            (sql, fields) = cls._getStatement("INSERT")
+            if upsert:
+                sql += '\n' + cls._upsertClause(upsert)
+            curs.executemany(sql, values)
+        else:
+            raise ValueError, "Unknown bulk insert mode: %s" % mode
+
+    _bulkWrite = classmethod(_bulkWrite)
+
+    def deleteWhere(cls, where):
+        """Delete all rows matching where with one DELETE statement.
+
+        where is a list of clauses, like for getAll(), and may not be
+        empty. Cached objects will be reloaded on next access, (and so
+        raise NotFound if they were deleted).
+
+        Returns the number of rows deleted, if known by the database
+        module.
+        """
+        (where, params) = cls._splitWhere(where)
+        if not where:
+            raise ValueError, "deleteWhere() needs a where clause"
+        (sql, ) = cls._prepareSQL("DELETE", where)
+        curs = cls._cursor()
+        cls._execute(curs, sql, params)
+        count = curs.rowcount
+        curs.close()
+        cls._expireCached()
+        return count
+
+    deleteWhere = classmethod(deleteWhere)
+
+    def updateWhere(cls, values, where):
+        """Update all rows matching where with one UPDATE statement.
+
+        values is a dictionary from field names (as in _sqlFields) to
+        their new values. Only fields of _sqlTable that are not in
+        _sqlPrimary can be updated. where is a list of clauses, like for
+        getAll(), and may not be empty. Cached objects will be reloaded
+        on next access.
+
+        Returns the number of rows updated, if known by the database
+        module.
+        """
+        (where, params) = cls._splitWhere(where)
+        if not where:
+            raise ValueError, "updateWhere() needs a where clause"
+        (sql, fields) = cls._prepareSQL("UPDATE", where, values.keys())
+        if len(fields) <> len(values):
+            unknown = [field for field in values.keys()
+                       if field not in fields]
+            raise ValueError, "Can't update fields: %s" % unknown
+        setValues = [cls._sqlValue(values[field], field) for field in fields]
+        curs = cls._cursor()
+        cls._execute(curs, sql, setValues + params)
+        count = curs.rowcount
+        curs.close()
+        cls._expireCached()
+        return count
+
+    updateWhere = classmethod(updateWhere)
+
+    def _expireCached(cls):
+        """Make cached objects load again on next access.
+
+        Used after statements that might have changed any row.
+        Objects with unsaved changes are left alone. Preloaded classes
+        will be preloaded again, and cached results are forgotten.
+        """
+        cls._tablesWritten()
+        cls._preloaded = None
+        cache = getattr(cls, '_cache', {})
+        for (key, (ref, updated)) in cache.items():
+            object = ref()
+            if object is None:
+                # Dead, might as well clean up
+                del cache[key]
+            elif isinstance(object, cls) and not object._changed:
+                object._updated = None
+
+    _expireCached = classmethod(_expireCached)
+
+    def getAll(cls, where=None, orderBy=None, lazy=False, page=100):
         """Retrieve all the objects.
 
         If a list of ``where`` clauses are given, they will be AND-ed
-        and will limit the search.
+        and will limit the search. A clause may be a (sql, params) pair,
+        with a %s in sql for each value in params to be bound by the
+        database module.
 
         This will not load everything out from the database, but will
         create a large amount of objects with only the ID inserted.  The
         data will be loaded from the objects when needed by the regular
         load()-autocall.
+
+        If lazy is true, a LazySequence is returned instead of a list.
+        It fetches ``page`` loaded objects at a time when indexed,
+        sliced or iterated, and only counts the rows if len() is
+        needed.
         """
+        if lazy:
+            return LazySequence(cls, where, orderBy, page)
         ids = cls.getAllIDs(where, orderBy=orderBy)
         # Instansiate a lot of them
         if len(cls._sqlPrimary) > 1:
@@ -748,8 +2239,22 @@ My fields: %s""" % (selectfields, cls._sqlFields)
 
     getAll = classmethod(getAll)
 
+    def count(cls, where=None):
+        """Return the number of rows, possibly matching the where clauses.
+        """
+        (where, params) = cls._splitWhere(where)
+        (sql, fields) = cls._prepareSQL("COUNT", where)
+        curs = cls._cursor()
+        cls._execute(curs, sql, params)
+        (count,) = curs.fetchone()
+        curs.close()
+        return int(count)
+
+    count = classmethod(count)
+
     def getAllIterator(cls, where=None, buffer=100,
-                                         useObject=None, orderBy=None):
+                                         useObject=None, orderBy=None,
+                                         limit=None, offset=None):
         """Retrieve every object as an iterator.
 
         Possibly limitted by the where list of clauses that will be
@@ -762,11 +2267,18 @@ My fields: %s""" % (selectfields, cls._sqlFields)
         If useObject is given, this object is returned each time, but
         with new data. This can be used to avoid creating many new
         objects when only one object is needed each time.
+
+        If limit is given, at most limit objects are returned, skipping
+        the first offset rows. Give an orderBy to make this
+        predictable.
         """
-        (sql, fields) = cls._prepareSQL("SELECTALL", where, orderBy=orderBy)
-        curs = cls.cursor()
+        (where, params) = cls._splitWhere(where)
+        (sql, fields) = cls._prepareSQL("SELECTALL", where, orderBy=orderBy,
+                                        limit=limit, offset=offset)
+        curs = cls._cursor()
         fetchedAt = time.time()
-        curs.execute(sql)
+        cls._execute(curs, sql, params)
+        codecs = cls._loadCodecs(fields, curs)
 
         # We might start eating memory at this point
 
@@ -790,7 +2302,7 @@ My fields: %s""" % (selectfields, cls._sqlFields)
                 result._setID(ids)
             else:
                 result = forgetter(*ids)
-            result._loadFromRow(row, fields, curs)
+            result._loadFromRow(row, fields, curs, codecs)
             result._updated = fetchedAt
             return result
 
@@ -804,11 +2316,19 @@ My fields: %s""" % (selectfields, cls._sqlFields)
         Where should be some list of where clauses that will be joined
         with AND). Note that the result might be tuples if this table
         has a multivalue _sqlPrimary.
+
+        If _resultTimeout is set, the result may come from the cache.
         """
+        (where, params) = cls._splitWhere(where)
+        cacheKey = cls._resultKey('IDS', where, params, orderBy)
+        if cacheKey is not None:
+            result = cls._cachedResult(cacheKey)
+            if result is not None:
+                return result
         (sql, fields) = cls._prepareSQL("SELECTALL", where,
                                         cls._sqlPrimary, orderBy=orderBy)
-        curs = cls.cursor()
-        curs.execute(sql)
+        curs = cls._cursor()
+        cls._execute(curs, sql, params)
         # We might start eating memory at this point
         rows = curs.fetchall()
         curs.close()
@@ -821,6 +2341,8 @@ My fields: %s""" % (selectfields, cls._sqlFields)
             else:
                 ids = ids[0]
             result.append((ids))
+        if cacheKey is not None:
+            cls._cacheResult(cacheKey, result)
         return result
 
     getAllIDs = classmethod(getAllIDs)
@@ -831,10 +2353,18 @@ My fields: %s""" % (selectfields, cls._sqlFields)
         The list is composed of tuples in the format (id, description) -
         where description is a string composed by the fields from
         cls._shortView, joint with SEPERATOR.
+
+        If _resultTimeout is set, the result may come from the cache.
         """
+        (where, params) = cls._splitWhere(where)
+        cacheKey = cls._resultKey('TEXT', where, params, orderBy, SEPERATOR)
+        if cacheKey is not None:
+            result = cls._cachedResult(cacheKey)
+            if result is not None:
+                return result
         (sql, fields) = cls._prepareSQL("SELECTALL", where, orderBy=orderBy)
-        curs = cls.cursor()
-        curs.execute(sql)
+        curs = cls._cursor()
+        cls._execute(curs, sql, params)
         # We might start eating memory at this point
         rows = curs.fetchall()
         curs.close()
@@ -849,10 +2379,100 @@ My fields: %s""" % (selectfields, cls._sqlFields)
                 ids = ids[0]
             text = SEPERATOR.join([str(row[pos]) for pos in shortPos])
             result.append((ids, text))
+        if cacheKey is not None:
+            cls._cacheResult(cacheKey, result)
         return result
 
     getAllText = classmethod(getAllText)
 
+    def _resultKey(cls, kind, where, params, orderBy, *extra):
+        """Return the result cache key of a query, or None.
+
+        None is returned if _resultTimeout is not set, or if the
+        parameters can't be used as a key.
+        """
+        if not cls._resultTimeout:
+            return None
+        if type(orderBy) is types.ListType:
+            orderBy = tuple(orderBy)
+        key = (kind, tuple(where), tuple(params), orderBy) + extra
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    _resultKey = classmethod(_resultKey)
+
+    def _cachedResult(cls, key):
+        """Return a copy of the cached result for key, or None.
+
+        Results are too old after _resultTimeout seconds, or when any
+        of the tables in _tables have been written to since.
+        """
+        results = cls.__dict__.get('_results')
+        if not results or not results.has_key(key):
+            return None
+        (result, created, writes, size) = results[key]
+        if (time.time() - created > cls._resultTimeout or
+            writes <> cls._writeCount()):
+            del results[key]
+            return None
+        return list(result)
+
+    _cachedResult = classmethod(_cachedResult)
+
+    def _cacheResult(cls, key, result):
+        """Cache a copy of result under key, within _resultMemory."""
+        size = _resultSize(result)
+        if size > cls._resultMemory:
+            return
+        results = cls.__dict__.get('_results')
+        if results is None:
+            results = cls._results = {}
+        used = size
+        for entry in results.values():
+            used += entry[3]
+        if used > cls._resultMemory:
+            # Forget the oldest results until it fits
+            oldest = [(entry[1], oldKey)
+                      for (oldKey, entry) in results.items()]
+            oldest.sort()
+            for (created, oldKey) in oldest:
+                used -= results[oldKey][3]
+                del results[oldKey]
+                if used <= cls._resultMemory:
+                    break
+        results[key] = (list(result), time.time(), cls._writeCount(),
+                        size)
+
+    _cacheResult = classmethod(_cacheResult)
+
+    def _writeCount(cls):
+        """The number of writes to the tables in _tables so far."""
+        writes = 0
+        for table in cls._tables.keys():
+            writes += _tableWrites.get(table, 0)
+        return writes
+
+    _writeCount = classmethod(_writeCount)
+
+    def _tablesWritten(cls, tables=None):
+        """Note that tables (default: _sqlTable) have been written to.
+
+        Forgets the cached results of all classes reading from them.
+        In a transaction they are forgotten again on rollback.
+        """
+        if tables is None:
+            tables = (cls._sqlTable,)
+        for table in tables:
+            _tableWrites[table] = _tableWrites.get(table, 0) + 1
+        transaction = _currentTransaction()
+        if transaction is not None:
+            transaction.wrote(cls, tables)
+
+    _tablesWritten = classmethod(_tablesWritten)
+
     def getChildren(self, forgetter, field=None, where=None, orderBy=None):
         """Return the children that links to me.
 
@@ -861,22 +2481,14 @@ My fields: %s""" % (selectfields, cls._sqlFields)
         used as the pointer to me. Use this if you have multiple fields
         referring to my class.
         """
-        if type(where) in (types.StringType, types.UnicodeType):
-            where = (where,)
-
-        if not field:
-            for (i_field, i_class) in forgetter._userClasses.items():
-                if isinstance(self, i_class):
-                    field = i_field
-                    break # first one found is ok :=)
-        if not field:
-            raise "No field found, check forgetter's _userClasses"
+        field = forgetter._referenceField(self, field)
         sqlname = forgetter._sqlFields[field]
         myID = self._getID()[0] # assuming single-primary !
 
-        whereList = ["%s='%s'" % (sqlname, myID)]
-        if where:
-            whereList.extend(where)
+        # The same statement for every parent, the ID is bound as a
+        # parameter
+        whereList = [(sqlname + "=%s", (myID,))]
+        whereList.extend(forgetter._whereList(where))
         return forgetter.getAll(whereList, orderBy=orderBy)
 
     def getChildrenIterator(self, forgetter, field=None, where=None,
@@ -884,25 +2496,94 @@ My fields: %s""" % (selectfields, cls._sqlFields)
         """Like getChildren, except that it returns an
         iterator, like getAllIterator. An iterator should
         """
-        if type(where) in (types.StringType, types.UnicodeType):
-            where = (where,)
+        field = forgetter._referenceField(self, field)
+        sqlname = forgetter._sqlFields[field]
+        myID = self._getID()[0] # assuming single-primary !
+
+        # The same statement for every parent, the ID is bound as a
+        # parameter
+        whereList = [(sqlname + "=%s", (myID,))]
+        whereList.extend(forgetter._whereList(where))
 
+        return forgetter.getAllIterator(whereList, useObject=useObject,
+                                        orderBy=orderBy)
+
+    def getChildrenOf(cls, parents, field=None, where=None, orderBy=None,
+                      chunk=500):
+        """Return the children of many parents at once.
+
+        Like parent.getChildren(cls) for each of the parents, but
+        fetched and loaded with one query for each ``chunk`` parents,
+        using WHERE field IN (...).
+
+        Returns a dictionary from parent ID to a list of children. Every
+        parent is included, with an empty list if it has no children.
+        parents may be objects or IDs, but field must be given if they
+        are IDs. The IDs are the keys as given, even if the database
+        returns them as another type, ie. '1' for 1.
+        """
+        result = {}
+        ids = []
+        # The given IDs by their text, for IDs of another type
+        byText = {}
+        for parent in parents:
+            if isinstance(parent, Forgetter):
+                field = cls._referenceField(parent, field)
+                parent = parent._getID()[0] # assuming single-primary !
+            if not result.has_key(parent):
+                result[parent] = []
+                ids.append(parent)
+                byText[unicode(parent)] = parent
+        if not ids:
+            return result
         if not field:
-            for (i_field, i_class) in forgetter._userClasses.items():
-                if isinstance(self, i_class):
+            raise ValueError, "field must be given for parent IDs"
+        sqlname = cls._sqlFields[field]
+        where = cls._whereList(where)
+        for start in range(0, len(ids), chunk):
+            chunkIDs = ids[start:start+chunk]
+            marks = ', '.join(('%s',) * len(chunkIDs))
+            whereList = [("%s IN (%s)" % (sqlname, marks), chunkIDs)]
+            whereList.extend(where)
+            for child in cls.getAllIterator(whereList, orderBy=orderBy):
+                parent = child._referenceID(field)
+                if not result.has_key(parent):
+                    parent = byText.get(unicode(parent), parent)
+                    if not result.has_key(parent):
+                        raise ValueError, \
+                              "Child refers to %r, which is none of the " \
+                              "parent IDs. Give the IDs as the database " \
+                              "returns them." % parent
+                result[parent].append(child)
+        return result
+
+    getChildrenOf = classmethod(getChildrenOf)
+
+    def _referenceField(cls, parent, field=None):
+        """Return the field in cls that refers to parent.
+
+        If field is given it is returned as is, otherwise the first
+        field in _userClasses with parent's class is used.
+        """
+        if not field:
+            for (i_field, i_class) in cls._userClasses.items():
+                if isinstance(parent, i_class):
                     field = i_field
                     break # first one found is ok :=)
         if not field:
-            raise "No field found, check forgetter's _userClasses"
-        sqlname = forgetter._sqlFields[field]
-        myID = self._getID()[0] # assuming single-primary !
+            raise ValueError, "No field found, check forgetter's _userClasses"
+        return field
 
-        whereList = ["%s='%s'" % (sqlname, myID)]
-        if where:
-            whereList.extend(where)
+    _referenceField = classmethod(_referenceField)
 
-        return forgetter.getAllIterator(whereList, useObject=useObject,
-                                        orderBy=orderBy)
+    def _referenceID(self, field):
+        """Return the ID that field refers to, without loading it.
+
+        Other fields are returned as is."""
+        value = self._values[field]
+        if isinstance(value, Forgetter):
+            value = value._getID()[0] # assuming single-primary !
+        return value
 
     def __repr__(self):
         return self.__class__.__name__ + ' %s' % self._getID()
@@ -922,40 +2603,931 @@ My fields: %s""" % (selectfields, cls._sqlFields)
 
 class MysqlForgetter(Forgetter):
     """MySQL-compatible Forgetter"""
+
+    # MySQLdb converts dates and booleans itself
+    _typeCodecs = {}
+
+    # MySQL's PREPARE can't bind parameters from the client without
+    # extra round trips for SET @var, so the ordinary statements are
+    # used
+    _prepareStatements = False
+    _prepareModules = ()
+
+    def _bulkInsertChunk(cls, curs, fields, values, missing, upsert=False):
+        """Overloaded - we don't have sequences in mysql.
+
+        Rows without an ID are inserted with one multi-row INSERT,
+        assuming that the auto increment values are consecutive (the
+        case for InnoDB unless innodb_autoinc_lock_mode = 2).
+        """
+        if not missing:
+            cls._bulkWrite(curs, fields, values, upsert=upsert)
+            return
+        if len(cls._sqlPrimary) <> 1:
+            raise "Can't retrieve auto-inserted ID for multiple-primary-key"
+        isMissing = {}
+        for index in missing:
+            isMissing[index] = True
+        given = [row for (index, row) in enumerate(values)
+                 if not isMissing.has_key(index)]
+        if given:
+            cls._bulkWrite(curs, fields, given, upsert=upsert)
+        # Must be one statement to get consecutive IDs
+        cls._bulkWrite(curs, fields, [values[index] for index in missing],
+                       'values')
+        # Here's the mysql magic to get the first new ID
+        first = curs.insert_id()
+        position = fields.index(cls._sqlPrimary[0])
+        for (offset, index) in enumerate(missing):
+            values[index][position] = first + offset
+
+    _bulkInsertChunk = classmethod(_bulkInsertChunk)
+
+    def _upsertClause(cls, fields):
+        """Overloaded - MySQL uses ON DUPLICATE KEY UPDATE"""
+        update = []
+        for field in fields:
+            if field not in cls._sqlPrimary:
+                column = cls._sqlFields[field][len(cls._sqlTable)+1:]
+                update.append('%s=VALUES(%s)' % (column, column))
+        if not update:
+            # Nothing to update, but we must say something
+            field = cls._sqlPrimary[0]
+            column = cls._sqlFields[field][len(cls._sqlTable)+1:]
+            update.append('%s=%s' % (column, column))
+        return 'ON DUPLICATE KEY UPDATE\n    ' + ',\n    '.join(update)
+
+    _upsertClause = classmethod(_upsertClause)
+
     def _saveDB(self):
         """Overloaded - we don't have nextval() in mysql"""
         # We're a "fresh" copy now
         self._updated = time.time()
         if self._new:
             operation = 'INSERT'
+            if self._upsert and self._validID():
+                operation = 'UPSERT'
         else:
             operation = 'UPDATE'
-        (sql, fields) = self._prepareSQL(operation)
-        values = []
-        for field in fields:
-            value = getattr(self, field)
-            if isinstance(value, Forgetter):
-                # It's another object, we store only the ID
-                if value._new:
-                    # It's a new object too, it must be saved!
-                    value.save()
-                try:
-                    (value,) = value._getID()
-                except:
-                    raise "Can't reference multiple-primary-key: %s" % value
-            values.append(value)
-        cursor = self.cursor()
-        cursor.execute(sql, values)
-        # cursor.commit()
+        values = [codec.toSQL(getattr(self, field))
+                  for (field, codec) in self._saveCodecs(operation)]
+        # Without an ID we need insert_id() at once
+        if not (self._validID() and self._queueWrite(operation, values)):
+            cursor = self._cursor()
+            self._executeStatement(cursor, operation, values)
+            # cursor.commit()
 
-        if not self._validID():
-            if not len(self._getID()) == 1:
-                raise "Can't retrieve auto-inserted ID for multiple-primary-key"
-            # Here's the mysql magic to get the new ID
-            self._setID(cursor.insert_id())
-        cursor.close()
+            if not self._validID():
+                if not len(self._getID()) == 1:
+                    raise "Can't retrieve auto-inserted ID for multiple-primary-key"
+                # Here's the mysql magic to get the new ID
+                self._setID(cursor.insert_id())
+            cursor.close()
+        if self._saveLinks:
+            self._saveLinked(operation == 'INSERT')
         self._new = False
 
+class _CopyData(object):
+    """Rows as a file in PostgreSQL's COPY text format.
+
+    Used with cursor.copy_from(), which only needs read() and
+    readline().
+    """
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = ''
+
+    def _line(self, row):
+        columns = []
+        for value in row:
+            if value is None:
+                columns.append('\\N')
+                continue
+            if type(value) is types.UnicodeType:
+                value = value.encode('utf8')
+            elif type(value) is types.FloatType:
+                # str() rounds to 12 digits
+                value = repr(value)
+            else:
+                value = str(value)
+            value = value.replace('\\', '\\\\').replace('\t', '\\t')
+            value = value.replace('\n', '\\n').replace('\r', '\\r')
+            columns.append(value)
+        return '\t'.join(columns) + '\n'
+
+    def _nextLine(self):
+        for row in self._rows:
+            return self._line(row)
+        return ''
+
+    def readline(self, size=-1):
+        if not self._buffer:
+            return self._nextLine()
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        line = self._buffer[:end]
+        self._buffer = self._buffer[end:]
+        return line
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = self._nextLine()
+            if not line:
+                break
+            self._buffer += line
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+
+class LazySequence(object):
+    """The objects of a forgetter as a sequence fetched page by page.
+
+    Returned by Forgetter.getAll(lazy=True). Indexing, slicing and
+    iteration fetch loaded objects ``page`` rows at a time using LIMIT
+    and OFFSET, and only the last page fetched is kept. len() counts
+    the rows once, and is avoided unless negative indexes are used.
+
+    Pages are separate queries, so rows inserted or deleted meanwhile
+    might shift objects between pages.
+    """
+    def __init__(self, forgetter, where=None, orderBy=None, page=100):
+        self._forgetter = forgetter
+        self._where = where
+        if not orderBy:
+            # Pages need a stable order
+            orderBy = forgetter._orderBy or tuple(forgetter._sqlPrimary)
+        self._orderBy = orderBy
+        self._page = page
+        self._length = None
+        self._pageNumber = None
+        self._objects = []
+
+    def _fetch(self, number):
+        """Return the objects of page number."""
+        if number <> self._pageNumber:
+            self._objects = list(self._forgetter.getAllIterator(
+                self._where, buffer=self._page, orderBy=self._orderBy,
+                limit=self._page, offset=number * self._page))
+            self._pageNumber = number
+        return self._objects
+
+    def __len__(self):
+        if self._length is None:
+            self._length = self._forgetter.count(self._where)
+        return self._length
+
+    def __nonzero__(self):
+        if self._length is not None:
+            return self._length > 0
+        return bool(self._fetch(0))
+
+    def __iter__(self):
+        number = 0
+        while True:
+            objects = self._fetch(number)
+            for object in objects:
+                yield object
+            if len(objects) < self._page:
+                break
+            number += 1
+
+    def __getitem__(self, index):
+        if type(index) is types.SliceType:
+            (start, stop, step) = (index.start, index.stop, index.step)
+            if ((start or 0) >= 0 and (stop is None or stop >= 0) and
+                step in (None, 1)):
+                # No need to count
+                return self._slice(start or 0, stop)
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError, "LazySequence index out of range"
+        objects = self._fetch(index // self._page)
+        try:
+            return objects[index % self._page]
+        except IndexError:
+            raise IndexError, "LazySequence index out of range"
+
+    def _slice(self, start, stop):
+        result = []
+        if stop is not None and stop <= start:
+            return result
+        number = start // self._page
+        while stop is None or number * self._page < stop:
+            objects = self._fetch(number)
+            first = number * self._page
+            result += objects[max(start - first, 0):
+                              stop is not None and stop - first or None]
+            if len(objects) < self._page:
+                break
+            number += 1
+        return result
+
+    def __repr__(self):
+        return "<LazySequence of %s, page=%d>" % (
+            self._forgetter.__name__, self._page)
+
+
+# The number of writes to each table through forgetSQL, for
+# invalidating cached results, see Forgetter._tablesWritten()
+_tableWrites = {}
+
+def _resultSize(result):
+    """Rough size in bytes of a cached list of IDs or (id, text)"""
+    return len(repr(result)) + 40 * len(result)
+
+# Connections where statements have been prepared, each maps
+# statement name to sql
+_prepared = weakref.WeakKeyDictionary()
+_preparedByID = {}
+_statementCount = 0
+
+def _preparedOn(connection):
+    """Return the dictionary of statements prepared on connection"""
+    try:
+        prepared = _prepared.get(connection)
+        if prepared is None:
+            prepared = _prepared[connection] = {}
+    except TypeError:
+        # Can't make weak references to this connection, we'll have to
+        # keep it alive as long as its statements are registered
+        key = id(connection)
+        if not _preparedByID.has_key(key):
+            _preparedByID[key] = (connection, {})
+        prepared = _preparedByID[key][1]
+    return prepared
+
+def _statementName(forgetter, operation):
+    """Return a new unique name for a prepared statement"""
+    global _statementCount
+    _statementCount += 1
+    table = re.sub(r'\W', '_', forgetter._sqlTable)
+    return 'forgetsql_%s_%s_%d' % (table, operation.lower(),
+                                   _statementCount)
+
+class Transaction(object):
+    """A transaction on one connection, see transaction()."""
+    def __init__(self, connection, isolation=None, begin=False,
+                 snapshot=True):
+        self.connection = connection
+        self.isolation = isolation
+        self.begin = begin
+        self.snapshot = snapshot
+        self.started = None
+        # Objects used in the transaction, by (class, id)
+        self.objects = {}
+        # Queued writes as [sql, [params, ...]], in order
+        self.queue = []
+        # (class, id) of the queued writes, by table
+        self.pending = {}
+        # Objects, classes and tables written to, to forget on rollback
+        self.saved = []
+        self.written = {}
+        self.tables = {}
+
+    def start(self):
+        """Start the transaction in this thread."""
+        if _currentTransaction() is not None:
+            raise ValueError, "Already in a transaction"
+        if self.begin or self.isolation:
+            curs = self.connection.cursor()
+            if self.begin:
+                curs.execute("BEGIN")
+            if self.isolation:
+                curs.execute("SET TRANSACTION ISOLATION LEVEL " +
+                             self.isolation)
+            curs.close()
+        self.started = time.time()
+        _local.transaction = self
+        return self
+
+    __enter__ = start
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def _seen(self, cls, args, object):
+        """Register object as cls(*args) for the rest of the
+        transaction. With snapshot, objects loaded before the
+        transaction started will be loaded again."""
+        self.objects[(cls, args)] = object
+        updated = object.__dict__.get('_updated')
+        if (self.snapshot and updated and updated < self.started and
+            not object.__dict__.get('_changed')):
+            object._updated = None
+
+    def write(self, object, sql, params, table=None):
+        """Queue the statement sql with params, written by object to
+        table (by default its _sqlTable)."""
+        if self.queue and self.queue[-1][0] == sql:
+            self.queue[-1][1].append(params)
+        else:
+            self.queue.append([sql, [params]])
+        self.pending.setdefault(table or object._sqlTable, []).append(
+            (object.__class__, object._getID()))
+        self.saved.append(object)
+        self.written[object.__class__] = True
+
+    def wrote(self, cls, tables):
+        """Note that cls has written to tables, see
+        Forgetter._tablesWritten()."""
+        if cls._sqlTable:
+            self.written[cls] = True
+        for table in tables:
+            self.tables[table] = True
+
+    def flush(self):
+        """Send the queued writes, the same statements in a row
+        with one executemany()."""
+        if not self.queue:
+            return
+        (queue, self.queue) = (self.queue, [])
+        self.pending = {}
+        curs = self.connection.cursor()
+        try:
+            for (sql, paramsList) in queue:
+                if len(paramsList) == 1:
+                    curs.execute(sql, paramsList[0])
+                else:
+                    curs.executemany(sql, paramsList)
+        finally:
+            curs.close()
+
+    def queued(self, cls, id):
+        """Could the queued writes change the row of cls(*id)?
+
+        True if a table of cls is written to with the same id, or by
+        another class.
+        """
+        for table in cls._tables.keys():
+            for (other, otherID) in self.pending.get(table, ()):
+                if other is not cls or otherID == id:
+                    return True
+        return False
+
+    def commit(self):
+        """Send the queued writes and commit, or roll back if either
+        fails."""
+        try:
+            self.flush()
+            self.connection.commit()
+        except:
+            self.rollback()
+            raise
+        self._end()
+
+    def rollback(self):
+        """Forget the queued writes and roll back.
+
+        Objects and classes written to in the transaction will be
+        loaded again, see Forgetter._expireCached(), and cached results
+        from the tables written to are forgotten.
+        """
+        self.queue = []
+        self.pending = {}
+        try:
+            self.connection.rollback()
+        finally:
+            for cls in self.written.keys():
+                cls._expireCached()
+            Forgetter._tablesWritten(self.tables.keys())
+            for object in self.saved:
+                object._updated = None
+            self._end()
+
+    def _end(self):
+        if _currentTransaction() is self:
+            _local.transaction = None
+        self.objects = {}
+        self.saved = []
+        self.written = {}
+        self.tables = {}
+
+def transaction(connection, isolation=None, begin=False, snapshot=True):
+    """Run the statements of all forgetters in one transaction.
+
+    Used as::
+
+        with forgetSQL.transaction(connection):
+            shop = Shop(552)
+            shop.name = 'Corrected name'
+            shop.save()
+
+    Inside the block, all statements in this thread run on connection,
+    which is committed once at the end, or rolled back on exceptions.
+    (On Python older than 2.5, call start() and commit() or rollback()
+    on the returned Transaction instead.)
+
+    save() and delete() don't write at once, but queue their
+    statements until the next query, or the end, and send the same
+    statements in a row with one executemany(). Errors from writing
+    might therefore come later than from save().
+
+    MyClass(id) returns the same object throughout the transaction,
+    without expiring from the cache. If snapshot is true, cached
+    objects loaded before the transaction are loaded again on first
+    access, so that reads see the transaction's view of the database.
+    Use isolation (ie. 'REPEATABLE READ') to make that view a snapshot
+    of when the transaction started, and begin to send BEGIN first
+    for connections in autocommit mode.
+    """
+    return Transaction(connection, isolation, begin, snapshot)
+
+def _currentTransaction():
+    """The Transaction of this thread, or None"""
+    return getattr(_local, 'transaction', None)
+
+# Methods timed by Profiler, by the phase they are counted as
+_profiledPhases = {
+    '_prepareSQL': 'sql',
+    '_execute': 'execute',
+    '_executeStatement': 'execute',
+    '_bulkWrite': 'execute',
+    '_loadFromRow': 'decode',
+    '__new__': 'new',
+    '__init__': 'new',
+    'reset': 'reset',
+}
+
+# Methods the time of the phases is attributed to, when called from
+# outside other operations
+_profiledOperations = ('load', 'save', 'delete', 'getBy', 'getAll',
+                       'getAllIterator', 'getAllIDs', 'getAllText',
+                       'count', 'getChildren', 'getChildrenIterator',
+                       'getChildrenOf', 'bulkInsert', 'updateWhere',
+                       'deleteWhere', 'revalidate', 'preload')
+
+# Operations returning iterators, profiled for each step
+_profiledIterators = ('getAllIterator', 'getChildrenIterator')
+
+# The running Profiler, see profile()
+_profiler = None
+
+class Profiler(object):
+    """Time spent in each phase of forgetter operations, see profile()."""
+
+    # Phases in the order they are reported
+    phases = ('sql', 'execute', 'fetch', 'decode', 'new', 'reset')
+
+    def __init__(self, sample=1.0):
+        self.sample = sample
+        # By (class name, operation), as {'calls': n, 'seconds': s,
+        # 'phases': {phase: [seconds, calls]}}
+        self.stats = {}
+        # Operations seen, sampled or not
+        self.operations = 0
+        self.seconds = 0.0
+        self.started = None
+        self._patched = []
+
+    def start(self):
+        """Start profiling all forgetters in all threads."""
+        global _profiler
+        if _profiler is not None:
+            raise ValueError, "Already profiling"
+        for klass in (Forgetter, MysqlForgetter):
+            for name in klass.__dict__.keys():
+                if _profiledPhases.has_key(name):
+                    self._patch(klass, name, _profiledPhases[name])
+                elif name in _profiledOperations:
+                    self._patch(klass, name, None)
+        # Queued writes of transactions
+        self._patch(Transaction, 'flush', 'execute')
+        self._patchCursor()
+        _profiler = self
+        self.started = time.time()
+        return self
+
+    __enter__ = start
+
+    def stop(self):
+        """Stop profiling, the stats are kept."""
+        global _profiler
+        for (klass, name, original) in self._patched:
+            setattr(klass, name, original)
+        self._patched = []
+        if _profiler is self:
+            _profiler = None
+        if self.started is not None:
+            self.seconds += time.time() - self.started
+            self.started = None
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+        return False
+
+    def _patch(self, klass, name, phase):
+        """Replace the method name of klass with a timed one."""
+        original = klass.__dict__[name]
+        if isinstance(original, (classmethod, staticmethod)):
+            # Class methods and __new__, first argument is the class
+            function = getattr(klass, name)
+            function = getattr(function, 'im_func', function)
+            instance = False
+        else:
+            function = original
+            instance = True
+        profiler = self
+        def profiled(first, *args, **kwargs):
+            frames = getattr(_local, 'profiled', None)
+            if frames is None:
+                forgetter = first
+                if instance:
+                    forgetter = first.__class__
+                return profiler._operation(name, phase, forgetter, function,
+                                           (first,) + args, kwargs)
+            if not frames or phase is None:
+                # Not sampled, or part of an operation already
+                return function(first, *args, **kwargs)
+            return profiler._phase(frames, phase, function,
+                                   (first,) + args, kwargs)
+        if isinstance(original, classmethod):
+            profiled = classmethod(profiled)
+        elif isinstance(original, staticmethod):
+            profiled = staticmethod(profiled)
+        self._patched.append((klass, name, original))
+        setattr(klass, name, profiled)
+
+    def _patchCursor(self):
+        """Make _cursor() return cursors timing their fetches."""
+        original = Forgetter.__dict__['_cursor']
+        function = Forgetter._cursor.im_func
+        profiler = self
+        def _cursor(cls, flush=True):
+            cursor = function(cls, flush)
+            if getattr(_local, 'profiled', None):
+                return _ProfiledCursor(profiler, cursor)
+            return cursor
+        self._patched.append((Forgetter, '_cursor', original))
+        Forgetter._cursor = classmethod(_cursor)
+
+    def _operation(self, operation, phase, forgetter, function, args,
+                   kwargs):
+        """Run function as a new operation, if sampled."""
+        self.operations += 1
+        frames = []
+        if self.sample >= 1.0 or random.random() < self.sample:
+            key = (forgetter.__name__, operation)
+            record = self.stats.get(key)
+            if record is None:
+                record = self.stats[key] = {'calls': 0, 'seconds': 0.0,
+                                            'phases': {}}
+            frames.append(record)
+        result = self._run(frames, phase, function, args, kwargs, 1)
+        if operation in _profiledIterators:
+            return self._iterate(frames, result)
+        return result
+
+    def _run(self, frames, phase, function, args, kwargs, calls):
+        previous = getattr(_local, 'profiled', None)
+        _local.profiled = frames
+        start = time.time()
+        try:
+            if phase is None or not frames:
+                return function(*args, **kwargs)
+            return self._phase(frames, phase, function, args, kwargs)
+        finally:
+            _local.profiled = previous
+            if frames:
+                record = frames[0]
+                record['seconds'] += time.time() - start
+                record['calls'] += calls
+
+    def _iterate(self, frames, iterator):
+        """Run each step of iterator as part of its operation."""
+        while True:
+            yield self._run(frames, None, iterator.next, (), {}, 0)
+
+    def _phase(self, frames, phase, function, args, kwargs):
+        """Run function, counting the time not spent in other phases."""
+        nested = [0.0]
+        frames.append(nested)
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            frames.pop()
+            if len(frames) > 1:
+                frames[-1][0] += elapsed
+            phases = frames[0]['phases']
+            if not phases.has_key(phase):
+                phases[phase] = [0.0, 0]
+            phases[phase][0] += elapsed - nested[0]
+            phases[phase][1] += 1
+
+    def report(self):
+        """Return the time of each phase of each operation as text,
+        the most time consuming operations first.
+
+        The time of phases is their own, not including other phases,
+        the rest of the operation is counted as other.
+        """
+        lines = []
+        if self.sample < 1.0:
+            lines.append("Sampled %g%% of %d operations" %
+                         (self.sample * 100, self.operations))
+        entries = [(record['seconds'], key)
+                   for (key, record) in self.stats.items()]
+        entries.sort()
+        entries.reverse()
+        for (seconds, (className, operation)) in entries:
+            record = self.stats[(className, operation)]
+            lines.append("%s.%s: %d calls, %.3f s" % (className, operation,
+                         record['calls'], seconds))
+            other = seconds
+            for phase in self.phases:
+                if not record['phases'].has_key(phase):
+                    continue
+                (phaseSeconds, calls) = record['phases'][phase]
+                other -= phaseSeconds
+                lines.append("    %-8s %9.3f s %5.1f%% %9d calls" % (phase,
+                             phaseSeconds, _percent(phaseSeconds, seconds),
+                             calls))
+            other = max(other, 0.0)
+            lines.append("    %-8s %9.3f s %5.1f%%" % ('other', other,
+                         _percent(other, seconds)))
+        return '\n'.join(lines) + '\n'
+
+def _percent(part, whole):
+    if not whole:
+        return 0.0
+    return part * 100.0 / whole
+
+class _ProfiledCursor(object):
+    """A cursor timing fetchone(), fetchmany() and fetchall() as the
+    fetch phase, for Profiler."""
+    def __init__(self, profiler, cursor):
+        self._profiler = profiler
+        self._cursor = cursor
+
+    def __getattr__(self, key):
+        return getattr(self._cursor, key)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _fetch(self, function, args):
+        frames = getattr(_local, 'profiled', None)
+        if not frames:
+            return function(*args)
+        return self._profiler._phase(frames, 'fetch', function, args, {})
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone, ())
+
+    def fetchmany(self, *args):
+        return self._fetch(self._cursor.fetchmany, args)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall, ())
+
+def profile(sample=1.0):
+    """Time what forgetters spend on each phase of their operations.
+
+    Used as::
+
+        with forgetSQL.profile() as profiler:
+            for shop in Shop.getAllIterator():
+                shop.name
+        print profiler.report()
+
+    (or call start() and stop() on the returned Profiler.) While
+    profiling, the time of building SQL (_prepareSQL), executing,
+    fetching rows, decoding rows (_loadFromRow), creating objects
+    (__new__ and __init__) and reset() is counted for each class and
+    operation, like Shop.getAllIterator or Shop.load, in all threads.
+    Operations called by other operations are counted as part of
+    them. Nothing is changed when not profiling.
+
+    With sample less than 1.0, only that fraction of the operations
+    are timed, which makes the overhead smaller.
+    """
+    return Profiler(sample)
+
+class ChangeReplay(object):
+    """Apply row changes made by others to the cached objects of
+    forgetters, see replayChanges()."""
+    def __init__(self, forgetters, patch=True):
+        if type(forgetters) is types.DictType:
+            forgetters = forgetters.values()
+        self.patch = patch
+        # (forgetter, {field: column}, key columns or None), by table
+        self._tables = {}
+        for forgetter in forgetters:
+            if not (type(forgetter) is types.TypeType and
+                    issubclass(forgetter, Forgetter)):
+                continue
+            for table in forgetter._tables.keys():
+                self._tables.setdefault(table, []).append(
+                    (forgetter, _tableFields(forgetter, table),
+                     _tableKey(forgetter, table)))
+
+    def apply(self, table, key, values):
+        """Apply a change of the row of table with the primary key
+        columns in the dictionary key, to the new values of its
+        columns, or deleted if values is None."""
+        forgetters = self._tables.get(table)
+        if not forgetters:
+            return
+        Forgetter._tablesWritten((table,))
+        for (forgetter, fields, keyColumns) in forgetters:
+            args = None
+            if keyColumns is not None:
+                args = _changedID(keyColumns, key, values)
+            if args is None:
+                # Can't tell which object, all might be affected
+                forgetter._expireCached()
+                continue
+            cache = getattr(forgetter, '_cache', {})
+            object = None
+            if cache.has_key(args):
+                (ref, updated) = cache[args]
+                object = ref()
+            if values is None or object is None:
+                # Preload again without the deleted or with the new row
+                forgetter._preloaded = None
+            if object is None:
+                cache.pop(args, None)
+                continue
+            if (not isinstance(object, forgetter) or object._changed or
+                not object._updated):
+                # Unsaved changes win, unloaded objects are fine
+                continue
+            if values is None and table == forgetter._sqlTable:
+                del cache[args]
+                if forgetter._sqlUnique:
+                    object._indexUnique(remove=True)
+            if values is None or not self._patch(object, fields, values):
+                object._updated = None
+                continue
+            cache[args] = (ref, time.time())
+
+    def _patch(self, object, fields, values):
+        """Set the fields of object from values, return False if some
+        are missing."""
+        forgetter = object.__class__
+        for column in fields.values():
+            if not values.has_key(column):
+                return False
+        if not self.patch:
+            return False
+        if forgetter._sqlUnique:
+            object._indexUnique(remove=True)
+        for (field, column) in fields.items():
+            value = values[column]
+            if value is not None and forgetter._sqlTypes.has_key(field):
+                value = forgetter._fieldCodec(field).fromSQL(value)
+            object._values[field] = value
+        if forgetter._sqlUnique:
+            object._indexUnique()
+        object._updated = time.time()
+        return True
+
+    def replay(self, events):
+        """Apply each (table, key, values) of events, return the number
+        of events."""
+        count = 0
+        for (table, key, values) in events:
+            self.apply(table, key, values)
+            count += 1
+        return count
+
+def _tableFields(forgetter, table):
+    """Return the columns of table in forgetter, by field"""
+    fields = {}
+    for (field, sqlField) in forgetter._sqlFields.items():
+        if field in forgetter._sqlPrimary:
+            continue
+        (fieldTable, column) = sqlField.split('.')
+        if fieldTable == table:
+            fields[field] = column
+    return fields
+
+def _tableKey(forgetter, table):
+    """Return the columns of table with the primary key of forgetter,
+    directly or through _sqlLinks, or None if it's not known."""
+    links = {}
+    for link in forgetter._sqlLinks:
+        (link1, link2) = link[:2]
+        links[link1] = link2
+        links[link2] = link1
+    columns = []
+    for field in forgetter._sqlPrimary:
+        sqlField = forgetter._sqlFields[field]
+        if not sqlField.startswith(table + '.'):
+            sqlField = links.get(sqlField)
+            if sqlField is None or not sqlField.startswith(table + '.'):
+                return None
+        columns.append(sqlField[len(table)+1:])
+    return columns
+
+def _changedID(columns, key, values):
+    """Return the ID of the columns from key or values, or None"""
+    id = []
+    for column in columns:
+        if key and key.has_key(column):
+            id.append(key[column])
+        elif values and values.has_key(column):
+            id.append(values[column])
+        else:
+            return None
+    return tuple(id)
+
+def replayChanges(events, forgetters, patch=True):
+    """Keep cached objects fresh with row changes made by others.
+
+    events is an iterable of (table, key, values), where key is a
+    dictionary of the primary key columns of the changed row, and
+    values a dictionary of its new columns, or None if the row was
+    deleted, like those from readChanges() or notifyChanges().
+    forgetters is a list of prepared Forgetter classes, or a dictionary
+    like the one given to prepareClasses().
+
+    Loaded objects of the changed rows are patched with the new
+    values, and stay fresh for another _timeout seconds. Objects with
+    unsaved changes are left alone. If patch is false, or some of the
+    columns of the object are missing from values, or the row was
+    deleted, the object is loaded again on next access instead. When
+    the object can't be told from the key, ie. when the table is linked
+    by other columns than the primary key, all cached objects of the
+    class are loaded again. Cached results of getAllIDs() etc. from
+    the table are forgotten.
+
+    Returns the number of events, after events is exhausted.
+    """
+    return ChangeReplay(forgetters, patch).replay(events)
+
+def _changeEvent(data):
+    """Return the (table, key, values) of a decoded JSON change"""
+    return (data['table'], data.get('key'), data.get('values'))
+
+def readChanges(file, follow=False, interval=1.0):
+    """Read change events from file, for replayChanges().
+
+    Each line of file is a JSON object like::
+
+        {"table": "shop", "key": {"shop_id": 5},
+         "values": {"shop_id": 5, "name": "Shop 5", ...}}
+
+    with "values": null for deleted rows. If follow is true, lines
+    appended to the file are read as they come, checking every
+    interval seconds, like tail -f.
+    """
+    if json is None:
+        raise ImportError, "readChanges() needs the json module"
+    partial = ''
+    while True:
+        line = file.readline()
+        if not line:
+            if not follow:
+                break
+            time.sleep(interval)
+            continue
+        line = partial + line
+        if not line.endswith('\n') and follow:
+            # Still being written
+            partial = line
+            continue
+        partial = ''
+        line = line.strip()
+        if line:
+            yield _changeEvent(json.loads(line))
+
+def notifyChanges(connection, channel='forgetsql_changes', timeout=None):
+    """Listen for change events on a PostgreSQL channel, for
+    replayChanges().
+
+    The payload of each notification is a JSON object like the lines
+    read by readChanges(), as sent by a trigger calling pg_notify().
+    connection should be a psycopg2 connection in autocommit mode,
+    used for nothing else. With timeout, iteration stops after timeout
+    seconds without notifications.
+    """
+    import select
+    if json is None:
+        raise ImportError, "notifyChanges() needs the json module"
+    curs = connection.cursor()
+    curs.execute("LISTEN " + channel)
+    curs.close()
+    while True:
+        while connection.notifies:
+            notify = connection.notifies.pop(0)
+            yield _changeEvent(json.loads(notify.payload))
+        if select.select([connection], [], [], timeout) == ([], [], []):
+            if timeout is not None:
+                break
+        else:
+            connection.poll()
+
 def prepareClasses(locals):
     """Fix _userClasses and some stuff in classes.
 
@@ -968,6 +3540,9 @@ def prepareClasses(locals):
     after defining all classes in your local module.
     prepareClasses will only touch objects in the name space
     that is a subclassed of Forgetter.
+
+    Modules generated by forgetsql-generate --static contain
+    classes that are already prepared, and don't need this.
     """
     for (name, forgetter) in locals.items():
         if not (type(forgetter) is types.TypeType and
@@ -983,16 +3558,22 @@ def prepareClasses(locals):
                 forgetter._userClasses[key] = resolved
 
         forgetter._tables = {}
+        # Forget statements built before preparing, and the names
+        # they were prepared on the server with
+        forgetter._statements = {}
+        forgetter._statementNames = {}
+        forgetter._fieldCodecs = {}
+        forgetter._codecLists = {}
         # Update all fields with proper names
         for (field, sqlfield) in forgetter._sqlFields.items():
             forgetter._sqlFields[field] = forgetter._checkTable(sqlfield)
 
         newLinks = []
         for linkpair in forgetter._sqlLinks:
-            (link1, link2) = linkpair
+            (link1, link2) = linkpair[:2]
             link1=forgetter._checkTable(link1)
             link2=forgetter._checkTable(link2)
-            newLinks.append((link1, link2))
+            newLinks.append((link1, link2) + tuple(linkpair[2:]))
 
         forgetter._sqlLinks = newLinks
         forgetter._prepared = True
@@ -0,0 +1,1173 @@
+#!/usr/bin/env python
+#
+# Distributed under LGPL 2.1 or later
+# (c) Stian Soiland-Reyes 2002-2015
+# stian@soiland-reyes.com
+# https://github.com/stain/forgetSQL
+#
+"""Correctness tests for forgetSQL.
+
+The tests run against the in-process SQLite stand-in and generated
+schema of bench/forgetbench.py, see its documentation. Run with::
+
+    python test/test_forgetSQL.py
+"""
+
+import datetime
+import decimal
+import imp
+import itertools
+import os
+import re
+import sys
+import unittest
+from StringIO import StringIO
+
+# The stand-in from the benchmarks, which also puts the forgetSQL
+# from this source tree first on the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'bench'))
+import forgetbench
+import forgetSQL
+
+# bin/forgetsql-generate, for readCatalog()
+generate = imp.new_module('generate')
+execfile(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      os.pardir, 'bin', 'forgetsql-generate'),
+         generate.__dict__)
+
+
+class StandInTestCase(unittest.TestCase):
+    """Tests with a fresh stand-in database of a few hundred rows"""
+
+    rows = 200
+
+    def setUp(self):
+        self.connection = forgetbench.StandInConnection()
+        self.schema = forgetbench.Schema(self.connection, self.rows)
+        self.classes = self.schema.classes
+        self.Shop = self.classes['Shop']
+        self.Chain = self.classes['Chain']
+        self.Address = self.classes['Address']
+
+    def tearDown(self):
+        transaction = forgetSQL._currentTransaction()
+        if transaction is not None:
+            transaction._end()
+        self.connection.close()
+
+    def query(self, sql, params=()):
+        """Return the rows of sql, run directly on the database"""
+        curs = self.connection._connection.cursor()
+        curs.execute(sql, params)
+        rows = curs.fetchall()
+        curs.close()
+        return rows
+
+
+class TestBasics(StandInTestCase):
+    def testLoad(self):
+        shop = self.Shop(5)
+        self.assertEqual(shop.name, 'Shop 5')
+
+    def testSave(self):
+        shop = self.Shop(5)
+        shop.name = 'Renamed'
+        self.failUnless(shop.save())
+        self.assertEqual(self.query("SELECT name FROM shop WHERE shop_id=5"),
+                         [('Renamed',)])
+
+    def testGetAll(self):
+        shops = self.Shop.getAll(['shop.shop_id <= 10'], orderBy='id')
+        self.assertEqual([shop.id for shop in shops], range(1, 11))
+
+
+class TestWhere(StandInTestCase):
+    def testPair(self):
+        shops = self.Shop.getAll(("shop.name=%s", ("Shop 5",)))
+        self.assertEqual([shop.id for shop in shops], [5])
+
+    def testPlainAndPair(self):
+        where = ["shop.rating >= 0", ("shop.name=%s", ("Shop 5",))]
+        self.assertEqual(self.Shop.getAllIDs(where), [5])
+
+    def testTwoPairs(self):
+        where = [("shop.shop_id < %s", (10,)), ("shop.name=%s", ("Shop 5",))]
+        self.assertEqual(self.Shop.getAllIDs(where), [5])
+
+
+class PostgresLikeConnection(forgetbench.StandInConnection):
+    """A stand-in that says it's from a PostgreSQL module"""
+    __module__ = 'psycopg2.extensions'
+
+
+class PreparingCursor(forgetbench.StandInCursor):
+    """Emulates PREPARE and EXECUTE on SQLite"""
+
+    def execute(self, sql, params=None):
+        match = re.match(r'PREPARE (\w+) AS (.*)$', sql, re.S)
+        if match:
+            self._count(sql)
+            self.connection.prepared[match.group(1)] = re.sub(
+                r'\$\d+', '?', match.group(2))
+            return
+        match = re.match(r'EXECUTE (\w+)', sql)
+        if match:
+            self._count(sql)
+            return self._cursor.execute(
+                self.connection.prepared[match.group(1)],
+                tuple(params or ()))
+        return forgetbench.StandInCursor.execute(self, sql, params)
+
+
+class PreparingConnection(PostgresLikeConnection):
+    """A PostgreSQL-like view of the database of another stand-in"""
+    __module__ = 'psycopg2.extensions'
+
+    def __init__(self, connection):
+        self._connection = connection._connection
+        self.prepared = {}
+        self.resetStats()
+
+    def cursor(self):
+        return PreparingCursor(self)
+
+    def close(self):
+        pass
+
+
+class TestPreparedStatements(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.Shop._prepareStatements = True
+
+    def testNotPostgres(self):
+        self.connection.resetStats()
+        shop = self.Shop(5)
+        self.assertEqual(shop.name, 'Shop 5')
+        self.failIf(self.connection.stats.has_key('PREPARE'))
+        self.failUnless(self.Shop._prepareStatements)
+
+    def testFailedPrepareRaises(self):
+        connection = PostgresLikeConnection()
+        transaction = forgetSQL.transaction(connection).start()
+        try:
+            # SQLite has no PREPARE
+            self.assertRaises(forgetbench.sqlite3.OperationalError,
+                              self.Shop(5).load)
+        finally:
+            transaction.rollback()
+        self.failUnless(self.Shop._prepareStatements)
+
+    def testPrepared(self):
+        connection = PreparingConnection(self.connection)
+        forgetSQL.transaction(connection).start()
+        self.assertEqual(self.Shop(5).name, 'Shop 5')
+        self.assertEqual(self.Shop(6).name, 'Shop 6')
+        self.assertEqual(connection.stats['PREPARE'], 1)
+        self.assertEqual(connection.stats['EXECUTE'], 2)
+
+    def testPreparedAgain(self):
+        connection = PreparingConnection(self.connection)
+        forgetSQL.transaction(connection).start()
+        self.assertEqual(self.Shop(5).name, 'Shop 5')
+        del self.Shop._sqlFields['chain']
+        forgetSQL.prepareClasses(self.classes)
+        shop = self.Shop(6)
+        self.assertEqual(shop.name, 'Shop 6')
+        self.assertEqual(shop.rating, self.query(
+            "SELECT rating FROM shop WHERE shop_id=6")[0][0])
+        self.assertEqual(connection.stats['PREPARE'], 2)
+
+    def testMysql(self):
+        self.failIf(forgetSQL.MysqlForgetter._prepareStatements)
+        self.failIf(forgetSQL.MysqlForgetter._canPrepare(
+                    PostgresLikeConnection()))
+
+
+class TestResultCache(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.Shop._resultTimeout = 60
+
+    def queries(self, function, *args):
+        self.connection.resetStats()
+        result = function(*args)
+        return (result, self.connection.queries)
+
+    def testCached(self):
+        where = ['shop.shop_id <= 10']
+        (ids, queries) = self.queries(self.Shop.getAllIDs, where)
+        self.assertEqual(queries, 1)
+        ids.append(1000)
+        (again, queries) = self.queries(self.Shop.getAllIDs, where)
+        self.assertEqual(queries, 0)
+        self.assertEqual(again, range(1, 11))
+        (text, queries) = self.queries(self.Shop.getAllText, where)
+        (text, queries) = self.queries(self.Shop.getAllText, where)
+        self.assertEqual(queries, 0)
+        self.assertEqual(len(text), 10)
+
+    def testDisabled(self):
+        self.Shop._resultTimeout = 0
+        self.Shop.getAllIDs()
+        self.assertEqual(self.queries(self.Shop.getAllIDs)[1], 1)
+
+    def testTimeout(self):
+        self.Shop.getAllIDs()
+        for (key, entry) in self.Shop._results.items():
+            self.Shop._results[key] = (entry[0], entry[1] - 120) + entry[2:]
+        self.assertEqual(self.queries(self.Shop.getAllIDs)[1], 1)
+
+    def testWrites(self):
+        shop = self.Shop(5)
+        shop.name = 'Renamed'
+        for write in (shop.save,
+                      lambda: self.Shop.bulkInsert([{'name': 'New'}]),
+                      lambda: self.Shop.deleteWhere(['shop.shop_id = 1']),
+                      lambda: self.Shop.updateWhere({'rating': 1.0},
+                                                    ['shop.shop_id = 2']),
+                      # Another class of the same table
+                      lambda: self.classes['ShopFull'].deleteWhere(
+                          ['shop.shop_id = 3'])):
+            self.Shop.getAllIDs()
+            write()
+            (written, queries) = self.queries(self.Shop.getAllIDs)
+            self.assertEqual(queries, 1)
+        self.assertEqual(len(written), self.rows - 1)
+
+    def testOtherTables(self):
+        self.Shop.getAllIDs()
+        chain = self.Chain(1)
+        chain.name = 'Renamed'
+        chain.save()
+        self.assertEqual(self.queries(self.Shop.getAllIDs)[1], 0)
+
+    def testMemory(self):
+        self.Shop._resultMemory = 1000
+        # Too large
+        self.Shop.getAllIDs()
+        self.assertEqual(self.queries(self.Shop.getAllIDs)[1], 1)
+        for count in range(5, 9):
+            self.Shop.getAllIDs(['shop.shop_id <= %d' % count])
+        # The oldest is forgotten first
+        self.assertEqual(self.queries(self.Shop.getAllIDs,
+                                      ['shop.shop_id <= 8'])[1], 0)
+        self.assertEqual(self.queries(self.Shop.getAllIDs,
+                                      ['shop.shop_id <= 5'])[1], 1)
+
+
+class TestLazy(StandInTestCase):
+    def ids(self, objects):
+        return [object.id for object in objects]
+
+    def testSameAsList(self):
+        expected = self.Shop.getAllIDs(orderBy='id')
+        for page in (1, 7, 100, 200, 300):
+            lazy = self.Shop.getAll(orderBy='id', lazy=True, page=page)
+            self.assertEqual(self.ids(lazy), expected)
+            for index in (0, 6, 7, 199, -1, -200):
+                self.assertEqual(lazy[index].id, expected[index])
+            for (start, stop, step) in ((3, 17, None), (None, 5, None),
+                                        (190, None, None), (-5, None, None),
+                                        (None, None, 3), (5, 2, None),
+                                        (195, 300, None), (-3, -1, None)):
+                self.assertEqual(self.ids(lazy[start:stop:step]),
+                                 expected[start:stop:step])
+            self.assertEqual(len(lazy), len(expected))
+
+    def testIndexError(self):
+        lazy = self.Shop.getAll(lazy=True, page=7)
+        self.assertRaises(IndexError, lambda: lazy[self.rows])
+        self.assertRaises(IndexError, lambda: lazy[-self.rows-1])
+
+    def testEmpty(self):
+        lazy = self.Shop.getAll(['shop.shop_id < 0'], lazy=True)
+        self.failIf(lazy)
+        self.assertEqual(len(lazy), 0)
+        self.assertEqual(list(lazy), [])
+
+    def testFirstPage(self):
+        self.connection.resetStats()
+        lazy = self.Shop.getAll(['shop.shop_id > 10'], orderBy='id',
+                                lazy=True, page=10)
+        self.failUnless(lazy)
+        self.assertEqual(self.ids(lazy[:10]), range(11, 21))
+        self.assertEqual(lazy[0].name, 'Shop 11')
+        # One page, loaded, and no counting
+        self.assertEqual(self.connection.queries, 1)
+        self.assertEqual(len(lazy), self.rows - 10)
+        self.assertEqual(self.connection.stats['SELECT'], 2)
+
+    def testCount(self):
+        self.assertEqual(self.Shop.count(), self.rows)
+        self.assertEqual(self.Shop.count([("shop.shop_id <= %s", (10,))]),
+                         10)
+
+
+class TestProfile(StandInTestCase):
+    def tearDown(self):
+        if forgetSQL._profiler is not None:
+            forgetSQL._profiler.stop()
+        StandInTestCase.tearDown(self)
+
+    def testPhases(self):
+        profiler = forgetSQL.profile().start()
+        list(self.Shop.getAllIterator())
+        shop = self.Shop(3)
+        shop.load()
+        profiler.stop()
+        record = profiler.stats[('Shop', 'getAllIterator')]
+        self.assertEqual(record['calls'], 1)
+        phases = record['phases']
+        self.assertEqual(phases['sql'][1], 1)
+        self.assertEqual(phases['execute'][1], 1)
+        self.assertEqual(phases['decode'][1], self.rows)
+        self.failUnless(phases.has_key('fetch'))
+        self.failUnless(phases.has_key('new'))
+        self.failUnless(record['seconds'] >= 0)
+        phases = profiler.stats[('Shop', 'load')]['phases']
+        self.assertEqual(phases['decode'][1], 1)
+        # Operations within operations are counted as part of them
+        self.failIf(profiler.stats.has_key(('Shop', '_loadFromRow')))
+        self.failUnless(profiler.operations >= 3)
+
+    def testNested(self):
+        profiler = forgetSQL.profile().start()
+        self.Shop.getAll()
+        profiler.stop()
+        self.assertEqual(profiler.stats.keys(), [('Shop', 'getAll')])
+
+    def testReport(self):
+        profiler = forgetSQL.profile().start()
+        self.Shop.count()
+        profiler.stop()
+        report = profiler.report()
+        self.failUnless(report.startswith("Shop.count: 1 calls"))
+        self.failUnless(re.search(r"\n    execute .* 1 calls\n", report))
+        self.failUnless("\n    other " in report)
+
+    def testWith(self):
+        with forgetSQL.profile() as profiler:
+            self.assertEqual(forgetSQL._profiler, profiler)
+            self.Shop.count()
+        self.assertEqual(forgetSQL._profiler, None)
+        self.assertEqual(profiler.stats[('Shop', 'count')]['calls'], 1)
+        self.failUnless(profiler.seconds > 0)
+
+    def testAlreadyProfiling(self):
+        profiler = forgetSQL.profile().start()
+        self.assertRaises(ValueError, forgetSQL.profile().start)
+        profiler.stop()
+        forgetSQL.profile().start().stop()
+
+    def testUnpatched(self):
+        classes = (forgetSQL.Forgetter, forgetSQL.MysqlForgetter,
+                   forgetSQL.Transaction)
+        before = [klass.__dict__.copy() for klass in classes]
+        profiler = forgetSQL.profile().start()
+        self.assertNotEqual(forgetSQL.Forgetter.__dict__['load'],
+                            before[0]['load'])
+        profiler.stop()
+        for (klass, methods) in zip(classes, before):
+            self.assertEqual(klass.__dict__, methods)
+        self.Shop.count()
+        self.assertEqual(profiler.stats, {})
+
+    def testSampled(self):
+        profiler = forgetSQL.profile(0).start()
+        self.Shop.count()
+        self.Shop.getAllIDs()
+        profiler.stop()
+        self.assertEqual(profiler.stats, {})
+        self.assertEqual(profiler.operations, 2)
+        self.failUnless(profiler.report().startswith(
+            "Sampled 0% of 2 operations"))
+
+
+class TestReplayChanges(StandInTestCase):
+    def loaded(self, Class, id):
+        object = Class(id)
+        object.load()
+        return object
+
+    def shopValues(self, id, name):
+        return {'shop_id': id, 'name': name, 'chain_id': None,
+                'opened': None, 'rating': 2.5}
+
+    def testPatched(self):
+        shop = self.loaded(self.Shop, 5)
+        self.connection.resetStats()
+        events = [('shop', {'shop_id': 5}, self.shopValues(5, 'Changed'))]
+        self.assertEqual(forgetSQL.replayChanges(events, [self.Shop]), 1)
+        self.assertEqual(shop.name, 'Changed')
+        self.assertEqual(shop.rating, 2.5)
+        self.failUnless(shop._updated)
+        self.assertEqual(self.connection.queries, 0)
+
+    def testDictionary(self):
+        shop = self.loaded(self.Shop, 5)
+        events = [('shop', {'shop_id': 5}, self.shopValues(5, 'Changed')),
+                  ('nothing', {'id': 1}, None)]
+        self.assertEqual(forgetSQL.replayChanges(events, self.classes), 2)
+        self.assertEqual(shop.name, 'Changed')
+
+    def testMissingColumns(self):
+        shop = self.loaded(self.Shop, 5)
+        self.query("UPDATE shop SET name=? WHERE shop_id=?", ('Changed', 5))
+        forgetSQL.replayChanges([('shop', {'shop_id': 5},
+                                  {'name': 'Changed'})], [self.Shop])
+        # Loaded again instead
+        self.assertEqual(shop._updated, None)
+        self.assertEqual(shop.name, 'Changed')
+        self.assertEqual(shop.rating, self.loaded(self.Shop, 5).rating)
+
+    def testNoPatch(self):
+        shop = self.loaded(self.Shop, 5)
+        events = [('shop', {'shop_id': 5}, self.shopValues(5, 'Changed'))]
+        forgetSQL.replayChanges(events, [self.Shop], patch=False)
+        self.assertEqual(shop._updated, None)
+        self.assertEqual(shop.name, 'Shop 5')
+
+    def testDeleted(self):
+        shop = self.loaded(self.Shop, 5)
+        forgetSQL.replayChanges([('shop', {'shop_id': 5}, None)],
+                                [self.Shop])
+        self.assertEqual(shop._updated, None)
+        self.failIf(self.Shop._cache.has_key((5,)))
+        self.failIf(self.Shop(5) is shop)
+
+    def testUnsaved(self):
+        shop = self.loaded(self.Shop, 5)
+        shop.name = 'Mine'
+        events = [('shop', {'shop_id': 5}, self.shopValues(5, 'Changed'))]
+        forgetSQL.replayChanges(events, [self.Shop])
+        self.assertEqual(shop.name, 'Mine')
+        self.failUnless(shop._changed)
+
+    def testLinked(self):
+        ShopFull = self.classes['ShopFull']
+        shop = self.loaded(ShopFull, 5)
+        other = self.loaded(ShopFull, 6)
+        self.connection.resetStats()
+        events = [('shop_info', {'shop_id': 5},
+                   {'shop_id': 5, 'description': 'New', 'phone': '1'})]
+        forgetSQL.replayChanges(events, self.classes)
+        self.assertEqual(shop.description, 'New')
+        self.assertEqual(shop.phone, '1')
+        self.assertEqual(shop.name, 'Shop 5')
+        self.assertEqual(other.description, 'About shop 6')
+        self.assertEqual(self.connection.queries, 0)
+
+    def testUnknownKey(self):
+        address = self.loaded(self.Address, 9)
+        # Address isn't keyed by shop_id, all addresses are expired
+        forgetSQL.ChangeReplay([self.Address]).apply('address',
+                                                     {'shop_id': 5}, None)
+        self.assertEqual(address._updated, None)
+
+    def testReadChanges(self):
+        file = StringIO('{"table": "shop", "key": {"shop_id": 5}, '
+                        '"values": {"shop_id": 5, "name": "Changed"}}\n'
+                        '\n'
+                        '{"table": "shop", "key": {"shop_id": 6}, '
+                        '"values": null}\n')
+        events = list(forgetSQL.readChanges(file))
+        self.assertEqual(events,
+                         [('shop', {'shop_id': 5},
+                           {'shop_id': 5, 'name': 'Changed'}),
+                          ('shop', {'shop_id': 6}, None)])
+
+    def testFollow(self):
+        class Growing:
+            # A file being appended to, in pieces
+            def __init__(self, pieces):
+                self.pieces = pieces
+            def readline(self):
+                if self.pieces:
+                    return self.pieces.pop(0)
+                return ''
+        file = Growing(['{"table": "shop", ', '',
+                        '"key": {"shop_id": 5}, "values": null}\n', '',
+                        '{"table": "chain", "values": null}\n'])
+        events = forgetSQL.readChanges(file, follow=True, interval=0)
+        self.assertEqual(list(itertools.islice(events, 2)),
+                         [('shop', {'shop_id': 5}, None),
+                          ('chain', None, None)])
+        self.failIf(file.pieces)
+
+
+class TestWhereWrites(StandInTestCase):
+    def testDeleteWhere(self):
+        shop = self.Shop(190)
+        self.assertEqual(shop.name, 'Shop 190')
+        self.assertEqual(self.Shop.deleteWhere(['shop.shop_id > 180']), 20)
+        self.assertEqual(self.query("SELECT COUNT(*) FROM shop"), [(180,)])
+        self.assertRaises(forgetSQL.NotFound, getattr, shop, 'name')
+
+    def testUpdateWhere(self):
+        shop = self.Shop(5)
+        self.assertEqual(shop.name, 'Shop 5')
+        changed = self.Shop(6)
+        changed.name = 'Changed'
+        count = self.Shop.updateWhere({'rating': 1.5},
+                                      [('shop.shop_id IN (%s, %s)', (5, 6))])
+        self.assertEqual(count, 2)
+        self.assertEqual(shop.rating, 1.5)
+        # Unsaved changes are kept
+        self.assertEqual(changed.name, 'Changed')
+
+    def testNeedsWhere(self):
+        self.assertRaises(ValueError, self.Shop.deleteWhere, [])
+        self.assertRaises(ValueError, self.Shop.updateWhere,
+                          {'rating': 1.5}, None)
+        self.assertEqual(self.query("SELECT COUNT(*) FROM shop"),
+                         [(self.rows,)])
+
+    def testUnknownField(self):
+        self.assertRaises(ValueError, self.Shop.updateWhere, {'id': 1},
+                          ['shop.shop_id = 5'])
+        self.assertRaises(ValueError, self.Shop.updateWhere, {'unknown': 1},
+                          ['shop.shop_id = 5'])
+
+
+class TestBulkInsert(StandInTestCase):
+    def testCopyFloat(self):
+        data = forgetSQL._CopyData([[0.12345678901234567, None, u'\xe6\t']])
+        self.assertEqual(data.read(),
+                         '0.12345678901234566\t\\N\t\xc3\xa6\\t\n')
+
+    def testModesStoreTheSame(self):
+        rating = 0.12345678901234567
+        for mode in ('values', 'executemany'):
+            self.Shop._bulkInsertMode = mode
+            (id,) = self.Shop.bulkInsert([{'name': 'New ' + mode,
+                                           'rating': rating}])
+            self.assertEqual(self.query("SELECT rating FROM shop "
+                                        "WHERE shop_id=?", (id,)),
+                             [(rating,)])
+        line = forgetSQL._CopyData([[rating]]).read()
+        self.assertEqual(float(line), rating)
+
+    def shop(self, id):
+        return self.query("SELECT name, chain_id, opened, rating FROM shop "
+                          "WHERE shop_id=?", (id,))[0]
+
+    def testUpsertPartial(self):
+        before = self.shop(1)
+        self.Shop.bulkInsert([{'id': 1, 'name': 'Renamed'}], upsert=True)
+        self.assertEqual(self.shop(1), ('Renamed',) + before[1:])
+
+    def testUpsertMixed(self):
+        for mode in ('values', 'executemany'):
+            self.Shop._bulkInsertMode = mode
+            (one, two) = (self.shop(1), self.shop(2))
+            ids = self.Shop.bulkInsert([{'id': 1, 'name': 'One ' + mode},
+                                        {'name': 'New ' + mode},
+                                        {'id': 2, 'name': 'Two ' + mode,
+                                         'rating': 4.5},
+                                        {'id': 3, 'name': 'Three ' + mode}],
+                                       upsert=True)
+            self.assertEqual(ids[0], 1)
+            self.assertEqual(ids[2:], [2, 3])
+            self.assertEqual(self.shop(1), ('One ' + mode,) + one[1:])
+            self.assertEqual(self.shop(2), ('Two ' + mode,) + two[1:3] +
+                                           (4.5,))
+            self.assertEqual(self.shop(ids[1]), ('New ' + mode, None, None,
+                                                 None))
+
+    def testUpsertObjects(self):
+        shop = self.Shop()
+        shop.id = 1
+        shop.name = 'Replaced'
+        self.Shop.bulkInsert([shop], upsert=True)
+        self.assertEqual(self.shop(1), ('Replaced', None, None, None))
+
+
+class TestUpsert(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.Shop._upsert = True
+
+    def testExisting(self):
+        shop = self.Shop()
+        shop.id = 5
+        shop.name = 'Replaced'
+        shop.rating = 1.0
+        self.failUnless(shop.save())
+        self.assertEqual(self.query("SELECT name, chain_id, rating FROM shop "
+                                    "WHERE shop_id=5"),
+                         [('Replaced', None, 1.0)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM shop"),
+                         [(self.rows,)])
+
+    def testNew(self):
+        shop = self.Shop()
+        shop.id = 1000
+        shop.name = 'New'
+        shop.save()
+        self.assertEqual(self.query("SELECT name FROM shop "
+                                    "WHERE shop_id=1000"), [('New',)])
+
+    def testWithoutID(self):
+        shop = self.Shop()
+        shop.name = 'New'
+        shop.save()
+        self.assertEqual(self.query("SELECT name FROM shop WHERE shop_id=?",
+                                    (shop.id,)), [('New',)])
+
+
+class VersionCodec(forgetSQL.Codec):
+    """Versions as 'v1', 'v2', ..."""
+
+    def toSQL(self, value):
+        return int(value[1:])
+
+    def fromSQL(self, value):
+        return 'v%d' % value
+
+
+class TestRevalidate(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.Chain._sqlVersion = 'version'
+        self.Chain._timeout = 60
+        self.Chain._autosave = False
+
+    def expire(self, *args):
+        (ref, updated) = self.Chain._cache[args]
+        self.Chain._cache[args] = (ref, updated - 120)
+
+    def testExpired(self):
+        chain = self.Chain(1)
+        chain.name
+        self.expire(1)
+        self.connection.resetStats()
+        self.failUnless(self.Chain(1) is chain)
+        self.assertEqual(self.connection.queries, 1)
+
+    def testTypedVersion(self):
+        self.Chain._codecs = dict(forgetSQL.Forgetter._codecs,
+                                  version=VersionCodec())
+        self.Chain._sqlTypes = {'version': 'version'}
+        chain = self.Chain(1)
+        self.assertEqual(chain.version, 'v1')
+        self.expire(1)
+        self.connection.resetStats()
+        self.failUnless(self.Chain(1) is chain)
+        self.assertEqual(self.connection.queries, 1)
+
+    def testChangedDoesNotRevalidateOthers(self):
+        changed = self.Chain(1)
+        changed.name = 'Changed'
+        other = self.Chain(2)
+        other.name
+        self.expire(1)
+        self.expire(2)
+        self.connection.resetStats()
+        self.failIf(self.Chain(1) is changed)
+        self.assertEqual(self.connection.queries, 0)
+        self.failUnless(self.Chain(2) is other)
+        self.assertEqual(self.connection.queries, 1)
+
+
+class TestGetBy(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.Shop._sqlUnique = ('name',)
+
+    def testCached(self):
+        self.connection.resetStats()
+        shop = self.Shop.getBy(name='Shop 5')
+        self.assertEqual(shop.id, 5)
+        self.failUnless(self.Shop.getBy(name='Shop 5') is shop)
+        self.assertEqual(self.connection.queries, 1)
+
+    def testChanged(self):
+        shop = self.Shop.getBy(name='Shop 5')
+        shop.name = 'Renamed'
+        self.connection.resetStats()
+        # Not saved, the database decides
+        self.assertEqual(self.Shop.getBy(name='Shop 5').id, 5)
+        self.assertEqual(self.connection.queries, 1)
+
+    def testNotFound(self):
+        self.assertRaises(forgetSQL.NotFound, self.Shop.getBy, name='None')
+
+    def testNotUnique(self):
+        self.assertRaises(ValueError, self.Shop.getBy, rating=1.0)
+
+    def testPruned(self):
+        self.Shop._uniqueIndexSize = 10
+        kept = [self.Shop.getBy(name='Shop %d' % id) for id in range(1, 6)]
+        for shop in self.Shop.getAllIterator():
+            pass
+        index = self.Shop._uniqueIndex(('name',))
+        self.failUnless(len(index) <= 20)
+        self.connection.resetStats()
+        for shop in kept:
+            self.failUnless(self.Shop.getBy(name=shop.name) is shop)
+        self.assertEqual(self.connection.queries, 0)
+
+
+class TestPreload(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.Chain._preload = True
+        self.Chain._preloadKeys = ('name',)
+
+    def testSave(self):
+        chain = self.Chain.getPreloaded(name='Chain 1')
+        chain.name = 'Renamed'
+        chain.save()
+        self.failUnless(self.Chain.getPreloaded(name='Renamed') is chain)
+        self.assertRaises(forgetSQL.NotFound, self.Chain.getPreloaded,
+                          name='Chain 1')
+
+    def testNew(self):
+        self.Chain.getPreloaded(name='Chain 1')
+        chain = self.Chain()
+        chain.name = 'New'
+        chain.version = 1
+        chain.save()
+        self.assertEqual(self.Chain.getPreloaded(name='New').id, chain.id)
+
+    def testBulkInsert(self):
+        self.Chain.getPreloaded(name='Chain 1')
+        (id,) = self.Chain.bulkInsert([{'name': 'Bulk', 'version': 1}])
+        self.assertEqual(self.Chain.getPreloaded(name='Bulk').id, id)
+
+    def testNotPreloaded(self):
+        shop = self.Shop(5)
+        shop.name = 'Renamed'
+        shop.save()
+        self.failIf(self.Shop.__dict__.has_key('_preloaded'))
+
+    def testGetBy(self):
+        self.Chain._sqlUnique = ('name',)
+        chain = self.Chain.getBy(name='Chain 2')
+        chain.name = 'Renamed'
+        chain.save()
+        self.failUnless(self.Chain.getBy(name='Renamed') is chain)
+
+
+class TestTransaction(StandInTestCase):
+    def testFailedCommit(self):
+        def commit():
+            raise forgetbench.sqlite3.OperationalError, "commit failed"
+        self.connection.commit = commit
+        transaction = forgetSQL.transaction(self.connection).start()
+        shop = self.Shop(5)
+        shop.name = 'Renamed'
+        shop.save()
+        self.assertRaises(forgetbench.sqlite3.OperationalError,
+                          transaction.commit)
+        self.failUnless(forgetSQL._currentTransaction() is None)
+        # Forgotten, as it was rolled back
+        self.failIf(shop._updated)
+        # And a new one can start
+        forgetSQL.transaction(self.connection).start().rollback()
+
+    def rolledBack(self, write, where=None):
+        """Return getAllIDs(where) after write, and check that it's
+        back to what it was after rolling back"""
+        self.Shop._resultTimeout = 60
+        before = self.Shop.getAllIDs(where)
+        transaction = forgetSQL.transaction(self.connection, begin=True)
+        transaction.start()
+        write()
+        written = self.Shop.getAllIDs(where)
+        transaction.rollback()
+        self.assertEqual(self.Shop.getAllIDs(where), before)
+        return written
+
+    def testDeleteWhereRolledBack(self):
+        written = self.rolledBack(
+            lambda: self.Shop.deleteWhere(['shop.shop_id > 180']))
+        self.assertEqual(len(written), 180)
+
+    def testUpdateWhereRolledBack(self):
+        written = self.rolledBack(
+            lambda: self.Shop.updateWhere({'name': 'Updated'},
+                                          ['shop.shop_id = 5']),
+            ["shop.name = 'Updated'"])
+        self.assertEqual(written, [5])
+
+    def testBulkInsertRolledBack(self):
+        written = self.rolledBack(
+            lambda: self.Shop.bulkInsert([{'name': 'New'}]))
+        self.assertEqual(len(written), self.rows + 1)
+
+    def testDeleted(self):
+        forgetSQL.transaction(self.connection).start()
+        address = self.Address(13)
+        address.load()
+        address.delete()
+        again = self.Address(13)
+        self.failIf(again is address)
+        self.assertEqual(again.id, 13)
+
+    def testLoadedOther(self):
+        forgetSQL.transaction(self.connection).start()
+        address = self.Address(13)
+        address.load(14)
+        again = self.Address(13)
+        self.failIf(again is address)
+        self.assertEqual(again.id, 13)
+        self.assertEqual(again.street, 'Street 13')
+
+
+class ChangedRowsCursor(forgetbench.StandInCursor):
+    """Counts changed rows, not matched ones, like MySQLdb"""
+
+    def _rowcount(self):
+        return 0
+    rowcount = property(_rowcount)
+
+
+class TestSaveLinks(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.ShopFull = self.classes['ShopFull']
+
+    def info(self, id):
+        return self.query("SELECT description, phone FROM shop_info "
+                          "WHERE shop_id=?", (id,))
+
+    def testUnchanged(self):
+        self.connection.cursor = lambda: ChangedRowsCursor(self.connection)
+        shop = self.ShopFull(5)
+        shop.rating = 1.0
+        shop.save()
+        self.assertEqual(self.info(5), [('About shop 5', '+47 00000005')])
+
+    def testMissing(self):
+        self.query("DELETE FROM shop_info WHERE shop_id=5")
+        shop = self.ShopFull(5)
+        shop.phone = '+47 12345678'
+        shop.save()
+        self.assertEqual(self.info(5), [(None, '+47 12345678')])
+
+    def testAtomic(self):
+        self.query("DELETE FROM shop_info WHERE shop_id=5")
+        self.query("CREATE TRIGGER fail BEFORE INSERT ON shop_info "
+                   "BEGIN SELECT RAISE(ABORT, 'failed'); END")
+        shop = self.ShopFull(5)
+        shop.name = 'Renamed'
+        shop.phone = '+47 12345678'
+        self.assertRaises(forgetbench.sqlite3.IntegrityError, shop.save)
+        self.failUnless(forgetSQL._currentTransaction() is None)
+        self.assertEqual(self.query("SELECT name FROM shop WHERE shop_id=5"),
+                         [('Shop 5',)])
+
+    def testBatched(self):
+        shop = self.ShopFull(5)
+        shop.phone = '+47 12345678'
+        self.connection.resetStats()
+        shop.save()
+        self.assertEqual(self.connection.stats,
+                         {'BEGIN': 1, 'SELECT': 1, 'UPDATE': 2, 'COMMIT': 1})
+        self.assertEqual(self.info(5), [('About shop 5', '+47 12345678')])
+
+    def testTransaction(self):
+        transaction = forgetSQL.transaction(self.connection).start()
+        shop = self.ShopFull(5)
+        shop.phone = '+47 12345678'
+        shop.save()
+        self.failIf(self.connection.stats.has_key('UPDATE'))
+        transaction.commit()
+        self.assertEqual(self.connection.stats['UPDATE'], 2)
+        self.assertEqual(self.info(5), [('About shop 5', '+47 12345678')])
+
+
+class TestReferences(StandInTestCase):
+    def testLazy(self):
+        address = self.Address(1)
+        address.load()
+        self.assertEqual(address._values['shop'], 1)
+        self.failUnless(address.shop is self.Shop(1))
+        self.failUnless(address._values['shop'] is address.shop)
+
+    def testTyped(self):
+        self.Address._sqlTypes = {'shop': 'raw'}
+        self.assertEqual(self.Address(1).shop, 1)
+
+    def testThroughCodec(self):
+        codec = self.Address._fieldCodec('shop')
+        self.failUnless(codec.userClass is self.Shop)
+        created = []
+        def fromSQL(value):
+            created.append(value)
+            return forgetSQL.ReferenceCodec.fromSQL(codec, value)
+        codec.fromSQL = fromSQL
+        shop = self.Address(1).shop
+        self.assertEqual(created, [1])
+        self.failUnless(isinstance(shop, self.Shop))
+
+
+class TestCodecs(StandInTestCase):
+    def roundTrip(self, name, value):
+        codec = forgetSQL.Forgetter._codecs[name]
+        stored = codec.toSQL(value)
+        loaded = codec.fromSQL(stored)
+        self.assertEqual(loaded, value)
+        self.assertEqual(type(loaded), type(value))
+        return stored
+
+    def testBoolean(self):
+        self.assertEqual(self.roundTrip('boolean', True), 't')
+        self.assertEqual(self.roundTrip('boolean', False), 'f')
+
+    def testDateTime(self):
+        self.assertEqual(self.roundTrip('datetime',
+                         datetime.datetime(2015, 1, 1, 10, 0, 0, 500)),
+                         '2015-01-01 10:00:00.000500')
+
+    def testDateTimeOffset(self):
+        tzinfo = forgetSQL._UTCOffset(120)
+        value = datetime.datetime(2015, 1, 1, 10, 0, 0, tzinfo=tzinfo)
+        self.assertEqual(self.roundTrip('datetime', value),
+                         '2015-01-01 10:00:00+02:00')
+        loaded = forgetSQL.DateTimeCodec().fromSQL('2015-01-01T08:00:00Z')
+        self.assertEqual(loaded, value)
+        loaded = forgetSQL.DateTimeCodec().fromSQL('2015-01-01 05:30:00-0230')
+        self.assertEqual(loaded, value)
+
+    def testDate(self):
+        self.assertEqual(self.roundTrip('date', datetime.date(2015, 1, 1)),
+                         '2015-01-01')
+
+    def testTime(self):
+        self.assertEqual(self.roundTrip('time', datetime.time(10, 0, 1)),
+                         '10:00:01')
+
+    def testTimeOffset(self):
+        value = datetime.time(10, 0, tzinfo=forgetSQL._UTCOffset(-90))
+        self.assertEqual(self.roundTrip('time', value), '10:00:00-01:30')
+
+    def testDecimal(self):
+        self.assertEqual(self.roundTrip('decimal',
+                                        decimal.Decimal('0.10')), '0.10')
+        self.assertEqual(forgetSQL.DecimalCodec().fromSQL(0.1),
+                         decimal.Decimal('0.1'))
+
+    def testRaw(self):
+        self.assertEqual(self.roundTrip('raw', 'x'), 'x')
+
+    def testNull(self):
+        for codec in forgetSQL.Forgetter._codecs.values():
+            self.assertEqual(codec.toSQL(None), None)
+            self.assertEqual(codec.fromSQL(None), None)
+
+    def testReference(self):
+        codec = forgetSQL.ReferenceCodec(self.Shop)
+        self.assertEqual(codec.toSQL(self.Shop(5)), 5)
+        self.failUnless(codec.fromSQL(5) is self.Shop(5))
+
+    def testStored(self):
+        self.Shop._sqlTypes = {'opened': 'datetime'}
+        value = datetime.datetime(2015, 1, 1, 10, 0,
+                                  tzinfo=forgetSQL._UTCOffset(120))
+        shop = self.Shop(5)
+        shop.opened = value
+        shop.save()
+        self.assertEqual(self.query("SELECT opened FROM shop "
+                                    "WHERE shop_id=5"),
+                         [('2015-01-01 10:00:00+02:00',)])
+        shop.load()
+        self.assertEqual(shop.opened, value)
+        self.assertEqual(shop.opened.utcoffset(),
+                         datetime.timedelta(hours=2))
+
+
+class TestChildren(StandInTestCase):
+    def ids(self, children):
+        result = {}
+        for (parent, objects) in children.items():
+            result[parent] = [object.id for object in objects]
+        return result
+
+    def testObjects(self):
+        children = self.Address.getChildrenOf([self.Shop(1), self.Shop(2)],
+                                              orderBy='id')
+        self.assertEqual(self.ids(children), {1: [1, 2], 2: [3, 4]})
+
+    def testIDs(self):
+        children = self.Address.getChildrenOf([1, 2, 1], field='shop',
+                                              orderBy='id', chunk=1)
+        self.assertEqual(self.ids(children), {1: [1, 2], 2: [3, 4]})
+
+    def testSameAsGetChildren(self):
+        shop = self.Shop(3)
+        children = self.Address.getChildrenOf([shop])
+        self.assertEqual(children[3], shop.getChildren(self.Address))
+
+    def testNoChildren(self):
+        children = self.Address.getChildrenOf([10**6], field='shop')
+        self.assertEqual(children, {10**6: []})
+
+    def testStringIDs(self):
+        children = self.Address.getChildrenOf(['1', '2'], field='shop',
+                                              orderBy='id')
+        self.assertEqual(self.ids(children), {'1': [1, 2], '2': [3, 4]})
+        children = self.Address.getChildrenOf([self.Shop('3')])
+        self.assertEqual(children.keys(), ['3'])
+        self.assertEqual(len(children['3']), 2)
+
+    def testWhere(self):
+        children = self.Address.getChildrenOf(
+            [1, 2], field='shop', where=["address.street = 'Street 2'"])
+        self.assertEqual(self.ids(children), {1: [2], 2: []})
+
+    def testNeedsField(self):
+        self.assertRaises(ValueError, self.Address.getChildrenOf, [1])
+
+
+class CatalogCursor:
+    """Returns canned catalog rows, the column rows first"""
+
+    def __init__(self, columns, keys):
+        self.results = [columns, keys]
+
+    def execute(self, sql):
+        self.rows = self.results.pop(0)
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class TestCatalog(unittest.TestCase):
+    columns = [('shop', 'shop_id', "nextval('shop_shop_id_seq'::regclass)"),
+               ('shop', 'chain_id', None),
+               ('shop', 'owner_id', None),
+               ('chain', 'chain_id', None),
+               ('owner', 'owner_id', None)]
+
+    def readCatalog(self, dialect, keys):
+        # The rows below are only what the query returns if it names
+        # the foreign key constraints
+        (columnSQL, keySQL) = generate.CATALOG[dialect]
+        self.failUnless("'FOREIGN KEY '" in keySQL)
+        cursor = CatalogCursor(self.columns, keys)
+        return generate.readCatalog(lambda: cursor, dialect)
+
+    def testPostgresql(self):
+        keys = [('chain', 'PRIMARY KEY', 'chain_id', None, None),
+                ('owner', 'PRIMARY KEY', 'owner_id', None, None),
+                ('shop', 'FOREIGN KEY shop_chain_id_fkey', 'chain_id',
+                 'chain', 'chain_id'),
+                ('shop', 'FOREIGN KEY shop_owner_id_fkey', 'owner_id',
+                 'owner', 'owner_id'),
+                ('shop', 'PRIMARY KEY', 'shop_id', None, None)]
+        shop = self.readCatalog('postgresql', keys)['shop']
+        self.assertEqual(shop['primary'], ['shop_id'])
+        self.assertEqual(shop['sequence'], 'shop_shop_id_seq')
+        self.assertEqual(shop['foreign'],
+                         {'chain_id': ('chain', 'chain_id'),
+                          'owner_id': ('owner', 'owner_id')})
+
+    def testMysql(self):
+        keys = [('chain', 'PRIMARY KEY', 'chain_id', None, None),
+                ('owner', 'PRIMARY KEY', 'owner_id', None, None),
+                ('shop', 'PRIMARY KEY', 'shop_id', None, None),
+                ('shop', 'FOREIGN KEY shop_ibfk_1', 'chain_id',
+                 'chain', 'chain_id'),
+                ('shop', 'FOREIGN KEY shop_ibfk_2', 'owner_id',
+                 'owner', 'owner_id')]
+        shop = self.readCatalog('mysql', keys)['shop']
+        self.assertEqual(shop['foreign'],
+                         {'chain_id': ('chain', 'chain_id'),
+                          'owner_id': ('owner', 'owner_id')})
+
+    def testMultipleColumns(self):
+        keys = [('shop', 'FOREIGN KEY shop_owner_fkey', 'chain_id',
+                 'owner', 'chain_id'),
+                ('shop', 'FOREIGN KEY shop_owner_fkey', 'owner_id',
+                 'owner', 'owner_id')]
+        shop = self.readCatalog('postgresql', keys)['shop']
+        self.assertEqual(shop['foreign'], {})
+
+    def testSqlite(self):
+        connection = forgetbench.sqlite3.connect(':memory:')
+        connection.executescript("""
+            CREATE TABLE chain (chain_id INTEGER PRIMARY KEY);
+            CREATE TABLE owner (owner_id INTEGER PRIMARY KEY);
+            CREATE TABLE shop (shop_id INTEGER PRIMARY KEY,
+                               chain_id INTEGER REFERENCES chain,
+                               owner_id INTEGER REFERENCES owner);""")
+        try:
+            shop = generate.readCatalog(connection.cursor, 'sqlite')['shop']
+        finally:
+            connection.close()
+        self.assertEqual(shop['primary'], ['shop_id'])
+        self.assertEqual(shop['foreign'],
+                         {'chain_id': ('chain', None),
+                          'owner_id': ('owner', None)})
+
+
+class TestGenerate(StandInTestCase):
+    def generate(self, static):
+        """Import the module generated for the stand-in database"""
+        output = StringIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            generate.generateFromTables(
+                ['shop', 'chain', 'address'],
+                self.connection._connection.cursor,
+                code={'module': 'sqlite3', 'database': 'test', 'connect': ''},
+                static=static)
+        finally:
+            sys.stdout = stdout
+        module = imp.new_module('generated')
+        exec output.getvalue() in module.__dict__
+        connection = self.connection
+        module._Wrapper.cursor = classmethod(lambda cls: connection.cursor())
+        module._Wrapper._dbModule = forgetbench.sqlite3
+        return module
+
+    def testStatic(self):
+        module = self.generate(True)
+        self.failUnless(module.Shop.__dict__.has_key('_statements'))
+        shop = module.Shop(5)
+        self.assertEqual(shop.name, 'Shop 5')
+        address = module.Address(1)
+        self.failUnless(address.shop is module.Shop(1))
+        shop.name = 'Renamed'
+        shop.save()
+        self.assertEqual(self.query("SELECT name FROM shop WHERE shop_id=5"),
+                         [('Renamed',)])
+
+    def testSameAsPrepared(self):
+        static = self.generate(True)
+        prepared = self.generate(False)
+        for name in ('Shop', 'Chain', 'Address'):
+            (staticClass, preparedClass) = (getattr(static, name),
+                                            getattr(prepared, name))
+            self.assertEqual(staticClass._sqlFields,
+                             preparedClass._sqlFields)
+            for operation in ('SELECT', 'INSERT', 'UPDATE'):
+                fields = list(staticClass._getStatement(operation)[1])
+                otherFields = list(preparedClass._getStatement(operation)[1])
+                fields.sort()
+                otherFields.sort()
+                self.assertEqual(fields, otherFields)
+            self.assertEqual(staticClass._getStatement('DELETE'),
+                             preparedClass._getStatement('DELETE'))
+            (one, other) = (staticClass(2), preparedClass(2))
+            one.load()
+            other.load()
+            self.assertEqual(repr(one._values), repr(other._values))
+
+    def testPreparedAgain(self):
+        module = self.generate(True)
+        forgetSQL.prepareClasses(vars(module))
+        self.assertEqual(module.Chain(2).name, 'Chain 2')
+        self.failUnless(module.Address(1).shop is module.Shop(1))
+
+
+if __name__ == '__main__':
+    unittest.main()